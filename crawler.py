@@ -4,12 +4,41 @@
 # This is simple web crawler. It dumps results onto json file.
 # Crawler uses common producer/consumer pattern, where producers crawl
 # pages and add links to shared queue, and consumer coordinates crawling.
-# It does not respect robots.txt so use with caution.
+# It respects robots.txt of crawled hosts: disallowed pages are not requested
+# and crawl-delay slows requests to host down (--ignore-robots turns it off).
+# With --sitemaps pages listed in sitemaps of seed host (named in robots.txt,
+# or /sitemap.xml) are crawled as well, even if nothing links to them.
 # CSS, Images, JS files, font files and links to some files count as assets,
 # iframes are ignored.
 # Crawler tries to find resources inside CSS styles as well.
-# Crawler does not retry failed requests.
+# Failed requests are retried with exponential backoff if failure looks
+# transient (timeouts, network errors, 429 and 5xx); pages which still could
+# not be fetched are reported with error reason.
+# Progress can be journaled to a frontier file (--frontier), so interrupted
+# crawl can be continued later with --resume without re-fetching pages.
+# With --jsonl report is streamed as JSON lines, one page per line, while
+# crawling; `crawler.py fold report.jsonl report.json` converts it back
+# to usual nested report.
+# With --http-cache validators (ETag/Last-Modified) and extracted links of
+# pages and stylesheets are kept between runs: unchanged resources are
+# requested conditionally and not parsed again.
+# Request latencies, downloaded bytes, parse times, cache hit rates and errors
+# are summarized at the end; with --metrics they are also dumped periodically
+# together with queue depth and pool occupancy.
+# With --processes N crawl is split between N processes by hash of uri, every
+# process has its own green pool and journal/cache files (suffixed with shard
+# number), links are passed to owning process through queues.
+# Crawl can be scoped by depth, number of pages, downloaded bytes, uri
+# patterns and path prefixes; paths with repeating segments are skipped as
+# crawler traps.
+# Responses are read in chunks and html is parsed while it is downloaded;
+# bodies larger than --max-body-size are not downloaded. Links with
+# extensions saying nothing about content type are requested with GET, which
+# is aborted after headers unless page is html, instead of HEAD and GET,
+# if they are going to be crawled (in scope and within budget).
 # Onli assets from the same domain are dumpet to report.
+# `crawler.py --test` runs unit tests of robots.txt parsing, canonical uris,
+# scope, visited set and CSS parsing.
 
 # Requirements.txt:
 # BeautifulSoup==3.2.1
@@ -24,13 +53,37 @@ from __future__ import print_function
 
 import re
 import sys
+import os
 import json
+import time
+import zlib
+import codecs
+import random
+import string
+import heapq
+import bisect
+import fnmatch
+import functools
+import hashlib
+import email.utils
+import argparse
 import urlparse
+import mimetypes
+import posixpath
+import unittest
+import collections
+import multiprocessing
 
+from array import array
+from Queue import Empty
 from itertools import ifilter
+from xml.parsers import expat
+from HTMLParser import HTMLParser, HTMLParseError
 
 import eventlet
+import eventlet.event
 import eventlet.timeout
+import eventlet.semaphore
 from eventlet.green import urllib2, socket, httplib
 
 from eventlet_log import create_logger
@@ -39,9 +92,155 @@ from BeautifulSoup import BeautifulSoup
 
 POOL_SIZE = 256
 TIMEOUT = 20
+CONTENT_TYPE_CACHE_SIZE = 100000
+CSS_CACHE_SIZE = 10000
+# query and path parameters which do not change page, shell patterns
+STRIP_PARAMS = ('utm_*', 'jsessionid', 'phpsessid', 'aspsessionid*',
+                'sessionid', 'sid')
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+# recently visited fingerprints are merged into sorted array in batches
+VISITED_BATCH = 4096
+# seconds between metrics snapshots
+METRICS_INTERVAL = 10
+# seconds between polls of inter-process queues
+SHARD_POLL = 0.05
+# path segment repeated more times than this means crawler trap,
+# like /calendar/next/next/next/...
+MAX_SEGMENT_REPEATS = 3
+# politeness: concurrency per host adapts between MIN and MAX
+HOST_CONCURRENCY = 8
+MIN_HOST_CONCURRENCY = 1
+MAX_HOST_CONCURRENCY = 64
+# requests per second per host, 0 means no limit
+HOST_RATE = 50
+# keep-alive connections kept per host
+CONNECTIONS_PER_HOST = MAX_HOST_CONCURRENCY
+MAX_REDIRECTS = 5
+# responses are read in chunks of CHUNK_SIZE bytes, bodies larger than
+# MAX_BODY_SIZE bytes (after decompression) are not downloaded
+CHUNK_SIZE = 64 * 1024
+MAX_BODY_SIZE = 10 * 1024 * 1024
+# unwanted bodies (errors, not html) up to DRAIN_SIZE bytes are read out to
+# keep connection alive, larger ones make it closed
+DRAIN_SIZE = 64 * 1024
+# parsed pages fetched while resolving content type are kept until they are
+# crawled; while that many are waiting, content type is requested with HEAD
+PREFETCH_CACHE_SIZE = 1000
+# user agent sent to hosts and looked for in robots.txt
+USER_AGENT = 'crawler'
+ROBOTS_CACHE_SIZE = 1000
+# seconds, crawl-delay from robots.txt is capped by this
+MAX_CRAWL_DELAY = 60
+# limits of sitemaps protocol: uncompressed size of single sitemap and
+# number of sitemaps followed from indexes
+SITEMAP_MAX_SIZE = 50 * 1024 * 1024
+MAX_SITEMAPS = 1000
+# retries: number of attempts and backoff bounds in seconds
+ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+# response slower than SLOW_FACTOR times average latency means congestion
+SLOW_FACTOR = 3
+# extensions which say nothing about content type of response
+DYNAMIC_EXTENSIONS = frozenset(['', '.php', '.asp', '.aspx', '.jsp', '.cgi',
+                                '.pl', '.py', '.do', '.action'])
 
 (log, log_exc, _) = create_logger('crawler')
 
+class Histogram(object):
+    '''Histogram of durations with exponential buckets from 1ms to ~65s.'''
+    BOUNDS = [0.001 * 2 ** i for i in range(17)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        '''Upper bound of bucket where q-quantile falls.'''
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+class Metrics(object):
+    '''Counters, gauges and histograms of current crawl.'''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = collections.defaultdict(Histogram)
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def snapshot(self):
+        return {
+            'time': time.time() - self.started,
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': dict((name, h.summary())
+                               for (name, h) in self.histograms.iteritems())
+        }
+
+    def hit_rate(self, name):
+        hits = self.counters[name + '.hits']
+        total = hits + self.counters[name + '.misses']
+        return float(hits) / total if total else None
+
+    def log_summary(self):
+        elapsed = time.time() - self.started
+        pages = self.counters['pages']
+        log('Crawled {} pages in {:.1f}s ({:.1f} pages/s), downloaded {} '
+            'bytes'.format(pages, elapsed, pages / elapsed if elapsed else 0,
+                           self.counters['bytes']))
+        for (name, histogram) in sorted(self.histograms.iteritems()):
+            summary = histogram.summary()
+            if summary['count']:
+                log('{}: {count} times, mean {mean:.3f}s, p50 {p50:.3f}s, '
+                    'p90 {p90:.3f}s, p99 {p99:.3f}s, max {max:.3f}s'.format(
+                        name, **summary))
+        for name in ('cache.content_type', 'cache.css', 'cache.http'):
+            rate = self.hit_rate(name)
+            if rate is not None:
+                log('{} hit rate: {:.1%}'.format(name, rate))
+        for (name, count) in sorted(self.counters.iteritems()):
+            if name.startswith('errors.'):
+                log('{}: {}'.format(name, count))
+
+metrics = Metrics()
+
 def drain_queue(queue):
     try:
         while True:
@@ -49,11 +248,190 @@ def drain_queue(queue):
     except eventlet.queue.Empty:
         raise StopIteration
 
+class Frontier(object):
+    '''Append-only journal of crawl progress.
+       Every uri put to worklist is recorded as `queued`, every crawled page
+       is recorded as `crawled` together with its assets and links, so crawl
+       state can be restored after crash or restart. Journal is continued
+       on resume and started anew otherwise, so records of previous crawl
+       are not replayed later.
+       Frontier without path keeps nothing on disk.
+    '''
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.journal = open(path, 'a' if resume else 'w') if path else None
+
+    def _write(self, record):
+        if self.journal is None:
+            return
+        # green threads do not switch inside plain file io, so lines
+        # are never interleaved
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+
+    def queued(self, uri, depth=0, target=None):
+        record = {'event': 'queued', 'uri': uri, 'depth': depth}
+        if target is not None and target != uri:
+            record['target'] = target
+        self._write(record)
+
+    def crawled(self, uri, assets, links_to, error=None):
+        record = {'event': 'crawled', 'uri': uri,
+                  'assets': list(assets), 'links_to': list(links_to)}
+        if error is not None:
+            record['error'] = error
+        self._write(record)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def load(self):
+        '''Replays journal, returns (crawled, pending), where crawled maps
+           uri to (assets, links_to, error) and pending is list of
+           (uri, depth, target) that were queued, but never crawled.
+        '''
+        crawled = {}
+        queued = []
+        try:
+            f = open(self.path)
+        except IOError:
+            return crawled, queued
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line could be cut by crash
+                    continue
+                if record['event'] == 'queued':
+                    queued.append((record['uri'], record.get('depth', 0),
+                                   record.get('target', record['uri'])))
+                elif record['event'] == 'crawled':
+                    crawled[record['uri']] = (set(record['assets']),
+                                              set(record['links_to']),
+                                              record.get('error'))
+        pending = []
+        seen = set(crawled)
+        for (uri, depth, target) in queued:
+            if uri not in seen:
+                seen.add(uri)
+                pending.append((uri, depth, target))
+        return crawled, pending
+
+class HTTPCache(object):
+    '''Validators and extracted data of previously fetched resources,
+       kept between runs in json lines file. Updates are appended, file is
+       compacted on close. Cache without path keeps nothing.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.journal = None
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry.pop('uri')] = entry
+        except IOError:
+            pass
+        self.journal = open(path, 'a')
+
+    def get(self, uri):
+        return self.entries.get(uri)
+
+    def validators(self, uri):
+        '''Returns headers to make request for uri conditional.'''
+        entry = self.entries.get(uri)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, uri, headers, data):
+        if self.journal is None:
+            return
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            # could not be validated next time
+            self.entries.pop(uri, None)
+            return
+        entry = {'etag': etag, 'last_modified': last_modified, 'data': data}
+        self.entries[uri] = entry
+        self.journal.write(json.dumps(dict(entry, uri=uri)) + '\n')
+        self.journal.flush()
+
+    def close(self):
+        if self.journal is None:
+            return
+        self.journal.close()
+        self.journal = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for (uri, entry) in self.entries.iteritems():
+                f.write(json.dumps(dict(entry, uri=uri)) + '\n')
+        os.rename(tmp_path, self.path)
+
+def report_record(assets, links_to, error=None):
+    record = {
+        'assets': list(assets),
+        'links_to': list(links_to)
+    }
+    if error is not None:
+        record['error'] = error
+    return record
+
+def stream_report(result, out):
+    '''Consumes result queue until None is received, writing every crawled
+       page to `out` as separate json line.
+    '''
+    while True:
+        item = result.get()
+        if item is None:
+            break
+        write_report_line(out, item)
+
+def write_report_line(out, item):
+    (uri, assets, links_to, error) = item
+    record = report_record(assets, links_to, error)
+    record['uri'] = uri
+    out.write(json.dumps(record) + '\n')
+    out.flush()
+
+def fold_report(lines):
+    '''Builds nested report from json lines written by stream_report.'''
+    res = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        res[record.pop('uri')] = record
+    return res
+
+CSS_URI_RE = re.compile(r'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^)'"\s]*))\s*\)'''
+                        r'''|@import\s+(?:"([^"]*)"|'([^']*)')''', re.I)
+
 def find_css_uris(css):
-    '''Catches url, such as background-url or font-url inside
-       CSS stylesheets.
+    '''Catches url, such as background-url or font-url, and @imports inside
+       CSS stylesheets. Inline data: uris are skipped.
     '''
-    return re.findall("url\('(.*?)'\)", css)
+    uris = []
+    for groups in CSS_URI_RE.findall(css):
+        uri = ''.join(groups).strip()
+        if uri and not uri.lower().startswith('data:'):
+            uris.append(uri)
+    return uris
 
 def normalize_uri(uri, default_scheme='https'):
     '''Tries to normalize uris, so //example.com becomes https://example.com,
@@ -74,6 +452,58 @@ def normalize_uri(uri, default_scheme='https'):
                                 parsed.query,
                                 ''))
 
+UNRESERVED = frozenset(string.ascii_letters + string.digits + '-._~')
+
+def normalize_escapes(part):
+    '''Decodes percent-escaped unreserved characters and uppercases
+       the rest of escapes, so %7e and %7E both become ~.
+    '''
+    def replace(match):
+        char = chr(int(match.group(1), 16))
+        if char in UNRESERVED:
+            return char
+        return '%' + match.group(1).upper()
+    return re.sub('%([0-9A-Fa-f]{2})', replace, part)
+
+def canonical_netloc(scheme, netloc):
+    netloc = netloc.lower()
+    default_port = DEFAULT_PORTS.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return netloc
+
+def make_canonicalizer(strip_params=STRIP_PARAMS, strip_trailing_slash=True):
+    '''Creates function which brings normalized uri to canonical form:
+       lowercase host without default port, normalized escapes, sorted
+       query without parameters matching strip_params, no trailing slash.
+       Uris pointing to the same page should become equal. Canonical uri
+       is only a key of page: relative links are resolved against uri,
+       which was actually fetched.
+    '''
+    strip_re = re.compile('|'.join(fnmatch.translate(p.lower())
+                                   for p in strip_params) or '$^')
+    def kept(param):
+        name = param.partition('=')[0]
+        return not strip_re.match(normalize_escapes(name).lower())
+    def canonicalize(uri):
+        parsed = urlparse.urlsplit(uri)
+        scheme = parsed.scheme.lower()
+        (path, _, params) = parsed.path.partition(';')
+        path = normalize_escapes(path) or '/'
+        if strip_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        params = [p for p in params.split(';') if p and kept(p)]
+        if params:
+            path = ';'.join([path] + params)
+        query = sorted(normalize_escapes(p) for p in parsed.query.split('&')
+                       if p and kept(p))
+        return urlparse.urlunsplit((scheme,
+                                    canonical_netloc(scheme, parsed.netloc),
+                                    path,
+                                    '&'.join(query),
+                                    ''))
+    return canonicalize
+
 def build_uri(uri, base_uri):
     return urlparse.urljoin(base_uri, uri)
 
@@ -88,137 +518,1736 @@ def make_uri_checker(netloc):
         else:
             uri = normalize_uri(uri)
             parsed_uri = urlparse.urlsplit(uri)
-            return parsed_uri.netloc == netloc
+            return canonical_netloc(parsed_uri.scheme,
+                                    parsed_uri.netloc) == netloc
     return checker
 
-def head_uri(uri, timeout=TIMEOUT):
-    try:
-        req = urllib2.Request(uri)
-        req.get_method = lambda : 'HEAD'
-        with eventlet.timeout.Timeout(timeout):
-            response = urllib2.urlopen(req)
-            return response.headers
-    except eventlet.timeout.Timeout as exc:
-        log('Timeout while requesting `{}`: {}'.format(uri, exc))
-    except (socket.error, urllib2.URLError, httplib.HTTPException) as exc:
+class Scope(object):
+    '''Limits what is crawled: uris are checked before they are enqueued,
+       budgets of pages and bytes stop crawl when exhausted. Include and
+       exclude are regexps searched in uri, prefixes are allowed path
+       prefixes. None or empty means no limit. Seed uri (depth 0) is always
+       in scope.
+    '''
+    def __init__(self, max_depth=None, max_pages=None, max_bytes=None,
+                 include=(), exclude=(), prefixes=(),
+                 max_repeats=MAX_SEGMENT_REPEATS):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.include = [re.compile(p) for p in include or ()]
+        self.exclude = [re.compile(p) for p in exclude or ()]
+        self.prefixes = tuple(prefixes or ())
+        self.max_repeats = max_repeats
+
+    def is_trap(self, path):
+        segments = collections.Counter(s for s in path.split('/') if s)
+        return any(count > self.max_repeats for count in segments.values())
+
+    def allows(self, uri, depth):
+        if depth == 0:
+            return True
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        path = urlparse.urlsplit(uri).path
+        if self.prefixes and not path.startswith(self.prefixes):
+            return False
+        if self.include and not any(p.search(uri) for p in self.include):
+            return False
+        if any(p.search(uri) for p in self.exclude):
+            return False
+        if self.max_repeats and self.is_trap(path):
+            log('Skipping crawler trap {}'.format(uri))
+            return False
+        return True
+
+    def exhausted(self, pages, bytes_):
+        return ((self.max_pages is not None and pages >= self.max_pages) or
+                (self.max_bytes is not None and bytes_ >= self.max_bytes))
+
+class VisitedSet(object):
+    '''Memory-compact set of uris: only 64-bit fingerprints of uris are kept.
+       New fingerprints go to small python set, which is merged in batches
+       into sorted array, where every fingerprint takes 8 bytes.
+    '''
+    def __init__(self, batch=VISITED_BATCH):
+        self.batch = batch
+        self.fingerprints = array(b'L')
+        self.recent = set()
+
+    def fingerprint(self, uri):
+        if isinstance(uri, unicode):
+            uri = uri.encode('utf-8')
+        digits = self.fingerprints.itemsize * 2
+        return int(hashlib.md5(uri).hexdigest()[:digits], 16)
+
+    def __contains__(self, uri):
+        fingerprint = self.fingerprint(uri)
+        if fingerprint in self.recent:
+            return True
+        i = bisect.bisect_left(self.fingerprints, fingerprint)
+        return (i < len(self.fingerprints) and
+                self.fingerprints[i] == fingerprint)
+
+    def __len__(self):
+        return len(self.fingerprints) + len(self.recent)
+
+    def add(self, uri):
+        if uri in self:
+            return
+        self.recent.add(self.fingerprint(uri))
+        # merge is linear, so batch grows with array to keep it amortized
+        if len(self.recent) >= max(self.batch, len(self.fingerprints) / 8):
+            self.fingerprints = array(b'L', heapq.merge(self.fingerprints,
+                                                        sorted(self.recent)))
+            self.recent = set()
+
+def parse_retry_after(value):
+    '''Retry-After is either number of seconds or http date.'''
+    if not value:
         return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, email.utils.mktime_tz(parsed) - time.time())
 
-def request(uri, timeout=TIMEOUT):
+class HostState(object):
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.active = 0
+        self.waiters = collections.deque()
+        self.next_start = 0
+        self.blocked_until = 0
+        self.latency = None
+        self.last_decrease = 0
+        # crawl-delay from robots.txt
+        self.delay = 0
+
+class Slot(object):
+    '''Single request to a host, see HostScheduler.slot.'''
+    def __init__(self, scheduler, host):
+        self.scheduler = scheduler
+        self.host = host
+        self.ok = True
+        self.retry_after = None
+
+    def failed(self, retry_after=None):
+        '''Marks request as failed because of host overload or network.'''
+        self.ok = False
+        self.retry_after = retry_after
+
+    def __enter__(self):
+        self.scheduler.acquire(self.host)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # FetchError tells about overload only if failed() was called,
+        # 404 or too large body is not a reason to slow down
+        if exc_type is not None and not issubclass(exc_type, FetchError):
+            self.ok = False
+        self.scheduler.release(self.host, self.ok,
+                               time.time() - self.started, self.retry_after)
+        return False
+
+class HostScheduler(object):
+    '''Limits concurrency and request rate per host.
+       Concurrency limit is adapted AIMD-style: it grows by one per window
+       of successful requests and is halved on errors, timeouts and
+       responses much slower than average. Retry-After pauses host entirely.
+       Crawl-delay of host, see set_delay, lowers its rate further.
+       Scheduler of one of `shares` processes, crawling the same hosts,
+       takes its share of concurrency and rate, and multiplies crawl-delay,
+       so hosts see the same load as from single process.
+    '''
+    def __init__(self, concurrency=HOST_CONCURRENCY, rate=HOST_RATE,
+                 min_concurrency=MIN_HOST_CONCURRENCY,
+                 max_concurrency=MAX_HOST_CONCURRENCY, shares=1):
+        self.shares = shares
+        self.concurrency = max(min_concurrency, concurrency // shares)
+        self.interval = float(shares) / rate if rate else 0
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(min_concurrency, max_concurrency // shares)
+        self.hosts = {}
+
+    def slot(self, uri):
+        return Slot(self, urlparse.urlsplit(uri).netloc)
+
+    def state(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.concurrency)
+        return self.hosts[host]
+
+    def set_delay(self, host, delay):
+        '''Makes requests to host start at least delay seconds apart.'''
+        state = self.state(host)
+        state.delay = min(delay, MAX_CRAWL_DELAY) * self.shares
+        log('Crawl delay of {} is {}s'.format(host, state.delay))
+
+    def acquire(self, host):
+        state = self.state(host)
+        while state.active >= int(state.limit):
+            event = eventlet.event.Event()
+            state.waiters.append(event)
+            event.wait()
+        state.active += 1
+        now = time.time()
+        start = max(now, state.next_start, state.blocked_until)
+        state.next_start = start + max(self.interval, state.delay)
+        if start > now:
+            eventlet.sleep(start - now)
+
+    def release(self, host, ok, latency, retry_after=None):
+        state = self.state(host)
+        state.active -= 1
+        now = time.time()
+        if retry_after is not None:
+            state.blocked_until = max(state.blocked_until, now + retry_after)
+        slow = (state.latency is not None and
+                latency > SLOW_FACTOR * state.latency)
+        if ok:
+            state.latency = (latency if state.latency is None
+                             else 0.8 * state.latency + 0.2 * latency)
+        if ok and not slow:
+            state.limit = min(self.max_concurrency,
+                              state.limit + 1 / state.limit)
+        # decrease at most once per average round-trip, as all requests
+        # in flight will likely fail at once
+        elif now - state.last_decrease > (state.latency or 0):
+            state.last_decrease = now
+            state.limit = max(self.min_concurrency, state.limit / 2)
+            log('Slowing down on {}: {} concurrent requests'.format(
+                host, int(state.limit)))
+        free = int(state.limit) - state.active
+        while free > 0 and state.waiters:
+            state.waiters.popleft().send()
+            free -= 1
+
+Response = collections.namedtuple('Response', 'status uri headers body size')
+REDIRECTS = frozenset([301, 302, 303, 307, 308])
+
+class BodyTooLarge(Exception):
+    pass
+
+class DeflateDecompressor(object):
+    '''Incremental deflate decompressor, which copes with raw deflate
+       stream without zlib header, sent by some servers.
+    '''
+    def __init__(self):
+        self.obj = None
+
+    def decompress(self, data, max_length=0):
+        if self.obj is None:
+            self.obj = zlib.decompressobj()
+            try:
+                return self.obj.decompress(data, max_length)
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.obj.decompress(data, max_length)
+
+    def flush(self):
+        return self.obj.flush() if self.obj is not None else b''
+
+def decompressor(encoding):
+    '''Returns incremental decompressor for content encoding or None.'''
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return DeflateDecompressor()
+    return None
+
+class Collector(object):
+    '''Default body reader: keeps whole body in memory.'''
+    def __init__(self, headers=None):
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        return b''.join(self.chunks)
+
+class HTTPClient(object):
+    '''Keeps pool of keep-alive connections per host, shared by all green
+       threads. At most `size` connections per host are open at once.
+       Redirects are followed, error statuses raise urllib2.HTTPError,
+       just like urlopen does.
+       Body is read in chunks and passed to reader, see request.
+    '''
+    def __init__(self, size=CONNECTIONS_PER_HOST, timeout=TIMEOUT,
+                 decode=True, max_body_size=MAX_BODY_SIZE):
+        self.size = size
+        self.timeout = timeout
+        self.decode = decode
+        self.max_body_size = max_body_size
+        self.idle = collections.defaultdict(list)
+        self.semaphores = {}
+
+    def connect(self, scheme, netloc):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def semaphore(self, key):
+        if key not in self.semaphores:
+            self.semaphores[key] = eventlet.semaphore.Semaphore(self.size)
+        return self.semaphores[key]
+
+    def perform(self, key, method, path, headers, read):
+        '''Sends request over idle or new connection to host `key`, body is
+           read with read(response), which returns (body, size, complete).
+        '''
+        with self.semaphore(key):
+            idle = self.idle[key]
+            reused = bool(idle)
+            conn = idle.pop() if reused else self.connect(*key)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # server closed idle connection, try once with fresh one
+                conn = self.connect(*key)
+                try:
+                    conn.request(method, path, headers=headers)
+                    response = conn.getresponse()
+                except:
+                    conn.close()
+                    raise
+            except:
+                # timeouts leave connection in unknown state
+                conn.close()
+                raise
+            try:
+                (body, size, complete) = read(response)
+            except:
+                conn.close()
+                raise
+            if response.will_close or not complete:
+                conn.close()
+            else:
+                idle.append(conn)
+        return response, body, size
+
+    def drain(self, response):
+        '''Reads out unwanted body, if it is small. Returns whether it was
+           read completely, so connection could be reused.
+        '''
+        if response.length is not None and response.length > DRAIN_SIZE:
+            return False
+        response.read(DRAIN_SIZE)
+        return response.isclosed()
+
+    def read_body(self, response, reader):
+        '''Feeds decoded body in chunks to reader(headers), which returns
+           object with feed(data) and close() methods or None, if content is
+           not wanted. Result of close() is returned as body. Reader, which
+           does not keep body in memory, may have own max_size.
+        '''
+        consumer = reader(response.msg)
+        if consumer is None:
+            return None, 0, self.drain(response)
+        limit = getattr(consumer, 'max_size', self.max_body_size)
+        if response.length is not None and response.length > limit:
+            raise BodyTooLarge(response.length)
+        decoder = None
+        if self.decode:
+            decoder = decompressor(response.getheader('Content-Encoding'))
+        size = 0
+        while True:
+            data = response.read(CHUNK_SIZE)
+            if not data:
+                break
+            if decoder is not None:
+                # never inflate more than limit allows
+                data = decoder.decompress(data, limit - size + 1)
+            size += len(data)
+            if size > limit:
+                raise BodyTooLarge(size)
+            consumer.feed(data)
+        if decoder is not None:
+            data = decoder.flush()
+            size += len(data)
+            if size > limit:
+                raise BodyTooLarge(size)
+            consumer.feed(data)
+        return consumer.close(), size, True
+
+    def request(self, method, uri, headers=None, reader=Collector):
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        if self.decode:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        def read(response):
+            if (method == 'HEAD' or response.status in (204, 304) or
+                    response.status in REDIRECTS or response.status >= 400):
+                return None, 0, self.drain(response)
+            return self.read_body(response, reader)
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse.urlsplit(uri)
+            path = urlparse.urlunsplit(('', '', parsed.path or '/',
+                                        parsed.query, ''))
+            key = (parsed.scheme, parsed.netloc)
+            (response, body, size) = self.perform(key, method, path, headers,
+                                                  read)
+            location = response.getheader('Location')
+            if response.status in REDIRECTS and location:
+                uri = build_uri(location, uri)
+                continue
+            if response.status >= 400:
+                raise urllib2.HTTPError(uri, response.status, response.reason,
+                                        response.msg, None)
+            return Response(response.status, uri, response.msg, body, size)
+        raise urllib2.HTTPError(uri, response.status, 'Too many redirects',
+                                response.msg, None)
+
+class FetchError(Exception):
+    def __init__(self, uri, reason, transient, retry_after=None, status=None):
+        super(FetchError, self).__init__('{}: {}'.format(uri, reason))
+        self.uri = uri
+        self.reason = reason
+        self.transient = transient
+        self.retry_after = retry_after
+        self.status = status
+
+class RetryPolicy(object):
+    '''Bounded number of attempts with exponential backoff and full jitter.'''
+    def __init__(self, attempts=ATTEMPTS, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(self.cap, retry_after))
+        return delay
+
+def http_failed(slot, exc):
+    '''Reports HTTPError to slot if it tells about server overload.'''
+    if exc.code == 429 or exc.code >= 500:
+        slot.failed(parse_retry_after(exc.info().get('Retry-After')))
+
+def attempt(method, uri, scheduler, client, timeout, headers=None,
+            reader=Collector):
+    '''Performs single request, failures are raised as FetchError.'''
+    metrics.incr('requests.' + method)
+    with scheduler.slot(uri) as slot:
+        try:
+            with eventlet.timeout.Timeout(timeout):
+                response = client.request(method, uri, headers, reader)
+            metrics.observe('latency.' + method, time.time() - slot.started)
+            metrics.incr('bytes', response.size)
+            return response
+        except eventlet.timeout.Timeout:
+            metrics.incr('errors.timeout')
+            slot.failed()
+            raise FetchError(uri, 'timeout', True)
+        except urllib2.HTTPError as exc:
+            metrics.incr('errors.http_{}'.format(exc.code))
+            http_failed(slot, exc)
+            transient = exc.code in (408, 429) or exc.code >= 500
+            raise FetchError(uri, 'HTTP {}'.format(exc.code), transient,
+                             slot.retry_after, exc.code)
+        except BodyTooLarge as exc:
+            metrics.incr('errors.body_too_large')
+            raise FetchError(uri, 'body too large: {} bytes'.format(exc),
+                             False)
+        except zlib.error as exc:
+            metrics.incr('errors.content_encoding')
+            raise FetchError(uri, 'bad content encoding: {}'.format(exc),
+                             False)
+        except (socket.error, urllib2.URLError,
+                httplib.HTTPException) as exc:
+            metrics.incr('errors.' + type(exc).__name__)
+            slot.failed()
+            raise FetchError(uri, '{}: {}'.format(type(exc).__name__, exc),
+                             True)
+
+def fetch(method, uri, scheduler, client, retry, timeout=TIMEOUT,
+          headers=None, reader=Collector):
+    '''Performs request, retrying transient failures according to retry
+       policy. Raises FetchError when request finally failed.
+    '''
+    for n in range(retry.attempts):
+        try:
+            return attempt(method, uri, scheduler, client, timeout, headers,
+                           reader)
+        except FetchError as exc:
+            if not exc.transient or n == retry.attempts - 1:
+                raise
+            delay = retry.delay(n, exc.retry_after)
+            log('Retrying {} {} in {:.1f}s: {}'.format(method, uri, delay,
+                                                      exc.reason))
+            eventlet.sleep(delay)
+
+def head_uri(uri, scheduler, client, retry, timeout=TIMEOUT):
     try:
-        with eventlet.timeout.Timeout(timeout):
-            return urllib2.urlopen(uri).read()
-    except eventlet.timeout.Timeout as exc:
-        log('Timeout while requesting `{}`: {}'.format(uri, exc))
-    except (socket.error, urllib2.URLError, httplib.HTTPException):
-        log_exc('Error, while requesting {}'.format(uri))
+        return fetch('HEAD', uri, scheduler, client, retry, timeout).headers
+    except FetchError as exc:
+        log('Error, while requesting {}'.format(exc))
         return None
 
-def get_uri_from_element(elem, base_uri, prop):
-    return build_uri(elem.get(prop), base_uri)
+def request(uri, scheduler, client, retry, timeout=TIMEOUT):
+    '''Returns body of uri, raises FetchError if it could not be fetched.'''
+    return fetch('GET', uri, scheduler, client, retry, timeout).body
 
-def extract_uris(elements, type_, base_uri, prop='src'):
-    for elem in elements:
-        elem_uri = get_uri_from_element(elem, base_uri, prop)
-        log('{} has - {}: {}'.format(base_uri, type_, elem_uri))
-        yield elem_uri
+class LRUCache(object):
+    '''Size-bounded cache shared by green threads. Concurrent misses of the
+       same key are computed once, see get_or_create.
+    '''
+    def __init__(self, size, name=None):
+        self.size = size
+        self.name = name
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
 
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        '''Returns cached value or calls create() to get it. Threads asking
+           for key while it is created wait for the result. None returned
+           by create is not cached.
+        '''
+        if key in self.entries:
+            if self.name:
+                metrics.incr('cache.{}.hits'.format(self.name))
+            return self.get(key)
+        if key in self.in_flight:
+            if self.name:
+                metrics.incr('cache.{}.hits'.format(self.name))
+            return self.in_flight[key].wait()
+        if self.name:
+            metrics.incr('cache.{}.misses'.format(self.name))
+        event = self.in_flight[key] = eventlet.event.Event()
+        value = None
+        try:
+            value = create()
+            if value is not None:
+                self.put(key, value)
+        finally:
+            del self.in_flight[key]
+            event.send(value)
+        return value
+
+def is_html(content_type):
+    return content_type.startswith('text/html')
+
+class ContentTypeResolver(object):
+    '''Finds out content type of uris, shared by all crawling threads.
+       Content type is guessed from extension where possible, otherwise
+       uri is requested once: concurrent requests for the same uri
+       wait for the first one and results are kept in LRU cache.
+       Uris, for which prefetch(uri, depth) is true, are requested with
+       fetch(uri, reader) instead of HEAD, see probe; uris, for which
+       allows(uri) is false, are not requested at all.
+    '''
+    def __init__(self, scheduler, client, retry, prefetch=None, fetch=None,
+                 allows=None, size=CONTENT_TYPE_CACHE_SIZE,
+                 pool_size=POOL_SIZE, prefetch_size=PREFETCH_CACHE_SIZE):
+        self.scheduler = scheduler
+        self.client = client
+        self.retry = retry
+        self.prefetch = prefetch
+        self.fetch = fetch
+        self.allows = allows
+        self.cache = LRUCache(size, 'content_type')
+        # fetched pages are not evicted: crawler takes or discards them
+        self.prefetched = {}
+        self.prefetch_size = prefetch_size
+        # separate pool: resolving from crawl pool could exhaust it
+        self.pool = eventlet.GreenPool(pool_size)
+
+    def guess(self, uri):
+        path = urlparse.urlsplit(uri).path
+        ext = posixpath.splitext(path)[1].lower()
+        if ext in DYNAMIC_EXTENSIONS:
+            return None
+        (content_type, _) = mimetypes.guess_type(path)
+        return content_type
+
+    def head(self, uri):
+        headers = head_uri(uri, self.scheduler, self.client, self.retry)
+        if headers is None:
+            return None
+        return headers.get('Content-Type', '')
+
+    def probe(self, uri, depth):
+        '''Requests content type of uri. Page, which is going to be crawled
+           anyway, is fetched (conditionally, if it is in http cache):
+           download stops after headers unless it is html, otherwise page is
+           parsed and kept for crawler in `prefetched` until it takes it,
+           which saves round-trip of HEAD.
+        '''
+        if (self.prefetch is None or not self.prefetch(uri, depth) or
+                len(self.prefetched) >= self.prefetch_size):
+            return self.head(uri)
+        try:
+            (response, cached) = self.fetch(uri, LinkReader.for_html)
+        except FetchError as exc:
+            log('Error, while requesting {}'.format(exc))
+            return None
+        if response is None:
+            # not modified, extraction of pages is kept as dict
+            if not isinstance(cached, dict):
+                return 'text/css'
+            self.prefetched[uri] = (None, cached)
+            return 'text/html'
+        content_type = response.headers.get('Content-Type', '')
+        if response.body is not None and is_html(content_type):
+            self.prefetched[uri] = (response, None)
+        return content_type
+
+    def resolve(self, uri, depth=None):
+        content_type = self.guess(uri)
+        if content_type:
+            metrics.incr('content_type.guessed')
+            return content_type
+        if self.allows is not None and not self.allows(uri):
+            return None
+        return self.cache.get_or_create(uri, lambda: self.probe(uri, depth))
+
+    def resolve_many(self, uris, depth=None):
+        '''Resolves uris, linked at depth, concurrently, yields
+           (uri, content_type) pairs.
+        '''
+        return self.pool.imap(lambda uri: (uri, self.resolve(uri, depth)),
+                              uris)
+
+class Robots(object):
+    '''Rules of robots.txt for our user agent. The longest matching Allow
+       or Disallow pattern wins (Allow on tie), patterns may contain * and
+       end with $. Sitemaps are listed regardless of user agent.
+    '''
+    def __init__(self, rules=(), delay=None, sitemaps=()):
+        rules = sorted(rules, key=lambda rule: (-len(rule[1]), not rule[0]))
+        self.rules = [(allow, self.compile(pattern))
+                      for (allow, pattern) in rules]
+        self.delay = delay
+        self.sitemaps = list(sitemaps)
+
+    @staticmethod
+    def compile(pattern):
+        anchored = pattern.endswith('$')
+        if anchored:
+            pattern = pattern[:-1]
+        regexp = '.*'.join(re.escape(part) for part in pattern.split('*'))
+        return re.compile(regexp + ('$' if anchored else ''))
+
+    @classmethod
+    def disallow_all(cls):
+        return cls([(False, '/')])
+
+    @classmethod
+    def parse(cls, text, agent=USER_AGENT):
+        '''Picks groups of rules naming our agent (user-agent value is
+           prefix of our product token), or * groups if there are no such.
+        '''
+        product = agent.split('/', 1)[0].lower()
+        groups = []
+        sitemaps = []
+        group = None
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            (field, sep, value) = line.partition(':')
+            if not sep:
+                continue
+            field = field.strip().lower()
+            value = value.strip()
+            if field == 'user-agent':
+                # consecutive user-agent lines share one group
+                if group is None or group['rules'] or group['delay']:
+                    group = {'agents': [], 'rules': [], 'delay': None}
+                    groups.append(group)
+                group['agents'].append(value.lower())
+            elif field == 'sitemap':
+                sitemaps.append(value)
+            elif group is None:
+                continue
+            elif field in ('allow', 'disallow') and value:
+                group['rules'].append((field == 'allow', value))
+            elif field == 'crawl-delay':
+                try:
+                    group['delay'] = float(value)
+                except ValueError:
+                    pass
+        chosen = [g for g in groups
+                  if any(a and a != '*' and product.startswith(a)
+                         for a in g['agents'])]
+        if not chosen:
+            chosen = [g for g in groups if '*' in g['agents']]
+        rules = [rule for g in chosen for rule in g['rules']]
+        delays = [g['delay'] for g in chosen if g['delay'] is not None]
+        return cls(rules, max(delays) if delays else None, sitemaps)
 
-def crawl_uri(uri, check_uri, css_cache, visited, worklist, result):
-    log('Crawling {}'.format(uri))
-    body = request(uri)
-    if not body:
-        return set(), set()
+    def allows(self, path):
+        for (allow, regexp) in self.rules:
+            if regexp.match(path):
+                return allow
+        return True
+
+class RobotsCache(object):
+    '''Fetches robots.txt once per host: concurrent requests wait for the
+       first one and rules are kept in LRU cache. Crawl-delay is passed to
+       scheduler. Missing robots.txt (4xx) allows everything, unreachable
+       one disallows everything, as robots exclusion protocol says.
+    '''
+    def __init__(self, scheduler, client, retry, size=ROBOTS_CACHE_SIZE):
+        self.scheduler = scheduler
+        self.client = client
+        self.retry = retry
+        self.cache = LRUCache(size, 'robots')
+
+    def load(self, scheme, netloc):
+        robots_uri = urlparse.urlunsplit((scheme, netloc, '/robots.txt', '',
+                                          ''))
+        try:
+            response = fetch('GET', robots_uri, self.scheduler, self.client,
+                             self.retry)
+        except FetchError as exc:
+            if exc.status is not None and 400 <= exc.status < 500:
+                return Robots()
+            log('Disallowing {}, robots.txt is unavailable: {}'.format(
+                netloc, exc.reason))
+            return Robots.disallow_all()
+        robots = Robots.parse(response.body.decode('utf-8', 'replace'))
+        if robots.delay:
+            self.scheduler.set_delay(netloc, robots.delay)
+        return robots
+
+    def get(self, uri):
+        parsed = urlparse.urlsplit(uri)
+        key = (parsed.scheme, parsed.netloc)
+        return self.cache.get_or_create(key, lambda: self.load(*key))
+
+    def allows(self, uri):
+        parsed = urlparse.urlsplit(uri)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        if self.get(uri).allows(path):
+            return True
+        metrics.incr('robots.disallowed')
+        return False
+
+class LinkExtractor(HTMLParser):
+    '''Collects uris of scripts, images, stylesheets and anchors in single
+       pass over html, without building document tree.
+    '''
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = collections.defaultdict(list)
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ('script', 'img', 'link', 'a'):
+            return
+        attrs = dict(attrs)
+        if tag in ('script', 'img'):
+            if attrs.get('src') is not None:
+                self.links[tag].append(attrs['src'])
+        elif tag == 'link':
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'stylesheet' in rel and attrs.get('href') is not None:
+                self.links['stylesheet'].append(attrs['href'])
+        elif attrs.get('href') is not None:
+            self.links['a'].append(attrs['href'])
+
+def extract_links_bs(body):
+    '''Same as extract_links, but uses BeautifulSoup, which copes with
+       html too broken for HTMLParser.
+    '''
     bs = BeautifulSoup(body)
+    links = collections.defaultdict(list)
+    for (tag, kind, attrs, prop) in (('script', 'script', {}, 'src'),
+                                     ('img', 'img', {}, 'src'),
+                                     ('link', 'stylesheet',
+                                      {'rel': 'stylesheet'}, 'href'),
+                                     ('a', 'a', {}, 'href')):
+        attrs = dict(attrs, **{prop: True})
+        for elem in bs.findAll(tag, attrs=attrs):
+            links[kind].append(elem.get(prop))
+    return links
+
+class LinkReader(object):
+    '''Body reader for HTTPClient, which feeds html to LinkExtractor while
+       it is downloaded. Html is decoded as utf-8, or latin-1 from the first
+       invalid chunk on. Raw body is kept as well, in case html is too broken
+       for HTMLParser and BeautifulSoup has to parse it again; its size is
+       bounded by client. close() returns links, as extract_links does.
+    '''
+    def __init__(self, headers=None):
+        self.parser = LinkExtractor()
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.chunks = []
+        self.broken = False
+        self.parse_time = 0
+
+    @classmethod
+    def for_html(cls, headers):
+        '''Returns reader, unless response is not html.'''
+        content_type = headers.get('Content-Type')
+        if content_type and not is_html(content_type):
+            return None
+        return cls(headers)
+
+    def decode(self, data, final=False):
+        try:
+            return self.decoder.decode(data, final)
+        except UnicodeDecodeError:
+            self.decoder = codecs.getincrementaldecoder('latin-1')()
+            return self.decoder.decode(data, final)
+
+    def parse(self, text):
+        if self.broken:
+            return
+        started = time.time()
+        try:
+            self.parser.feed(text)
+        except HTMLParseError:
+            log_exc('Falling back to BeautifulSoup')
+            self.broken = True
+        self.parse_time += time.time() - started
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.parse(self.decode(data))
+
+    def close(self):
+        self.parse(self.decode(b'', True))
+        if not self.broken:
+            try:
+                self.parser.close()
+            except HTMLParseError:
+                log_exc('Falling back to BeautifulSoup')
+                self.broken = True
+        metrics.observe('parse', self.parse_time)
+        if self.broken:
+            return extract_links_bs(b''.join(self.chunks))
+        return self.parser.links
+
+class SitemapReader(object):
+    '''Body reader for HTTPClient, which parses sitemap or sitemap index
+       with expat while it is downloaded, so huge sitemaps are never kept in
+       memory. Locations are passed to on_page or on_sitemap as soon as they
+       are parsed. Gzipped sitemaps are decompressed. close() returns number
+       of locations found.
+    '''
+    max_size = SITEMAP_MAX_SIZE
+
+    def __init__(self, on_page, on_sitemap):
+        self.on_page = on_page
+        self.on_sitemap = on_sitemap
+        self.parser = expat.ParserCreate(namespace_separator=' ')
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.data
+        # sitemaps have no business declaring entities
+        self.parser.EntityDeclHandler = self.reject_entity
+        self.decoder = None
+        self.started = False
+        self.size = 0
+        self.parent = None
+        self.loc = None
+        self.count = 0
+
+    def reject_entity(self, *args):
+        raise expat.ExpatError('entity declarations are not allowed')
+
+    def start(self, name, attrs):
+        tag = name.rsplit(' ', 1)[-1]
+        if tag in ('url', 'sitemap'):
+            self.parent = tag
+        elif tag == 'loc':
+            self.loc = []
+
+    def data(self, text):
+        if self.loc is not None:
+            self.loc.append(text)
+
+    def end(self, name):
+        tag = name.rsplit(' ', 1)[-1]
+        if tag != 'loc' or self.loc is None:
+            return
+        loc = ''.join(self.loc).strip()
+        self.loc = None
+        if not loc:
+            return
+        self.count += 1
+        if self.parent == 'sitemap':
+            self.on_sitemap(loc)
+        else:
+            self.on_page(loc)
+
+    def feed(self, data):
+        if not self.started:
+            self.started = True
+            if data.startswith(b'\x1f\x8b'):
+                self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.decoder is not None:
+            data = self.decoder.decompress(data, self.max_size - self.size + 1)
+            self.size += len(data)
+            if self.size > self.max_size:
+                raise BodyTooLarge(self.size)
+        self.parser.Parse(data, False)
+
+    def close(self):
+        self.parser.Parse(b'', True)
+        return self.count
+
+def extract_links(body):
+    '''Returns mapping from kind of link (script, img, stylesheet, a)
+       to list of uris, as written in html.
+    '''
+    reader = LinkReader()
+    reader.feed(body)
+    return reader.close()
+
+def extract_uris(values, type_, base_uri):
+    for value in values:
+        value_uri = build_uri(value, base_uri)
+        log('{} has - {}: {}'.format(base_uri, type_, value_uri))
+        yield value_uri
+
+
+class Crawl(object):
+    '''State of single crawl, shared by all crawling threads.'''
+    def __init__(self, check_uri, canonicalize, frontier, scheduler, client,
+                 retry, http_cache, scope, robots=True, sitemaps=False):
+        self.check_uri = check_uri
+        self.sitemaps = sitemaps
+        self.scope = scope
+        self.canonicalize = canonicalize
+        self.frontier = frontier
+        self.http_cache = http_cache
+        self.scheduler = scheduler
+        self.client = client
+        self.retry = retry
+        self.robots = RobotsCache(scheduler, client, retry)
+        self.respect_robots = robots
+        self.resolver = ContentTypeResolver(scheduler, client, retry,
+                                            prefetch=self.prefetches,
+                                            fetch=self.fetch,
+                                            allows=self.robots_allow)
+        self.css_cache = LRUCache(CSS_CACHE_SIZE, 'css')
+        self.visited = VisitedSet()
+        self.worklist = eventlet.Queue()
+        self.result = eventlet.Queue()
+        self.in_flight = 0
+        self.bytes = 0
+
+    def fetch(self, uri, reader=Collector):
+        '''GETs uri, conditionally if it is in http cache. Returns
+           (response, data), where data is extraction cached for uri if it
+           was not modified (response is None then).
+        '''
+        headers = self.http_cache.validators(uri)
+        response = fetch('GET', uri, self.scheduler, self.client, self.retry,
+                         headers=headers, reader=reader)
+        if response.status == 304 and headers:
+            metrics.incr('cache.http.hits')
+            return None, self.http_cache.get(uri)['data']
+        if headers:
+            metrics.incr('cache.http.misses')
+        self.bytes += response.size
+        return response, None
+
+    def fetch_page(self, uri, prefetched=None):
+        '''Same as fetch, but body of response is links found on page,
+           or None if it is not html. Page could be already fetched by
+           content type resolver, see take_prefetched.
+        '''
+        if prefetched is None:
+            return self.fetch(uri, LinkReader.for_html)
+        metrics.incr('prefetch.used')
+        return prefetched
+
+    def take_prefetched(self, uri):
+        '''Returns (response, data) of page prefetched for uri and forgets
+           it, or None. Page is taken when it is dispatched, so it is not
+           discarded while waiting for free green thread.
+        '''
+        return self.resolver.prefetched.pop(uri, None)
+
+    def discard(self, uri):
+        '''Drops page prefetched for uri, which is not going to be
+           crawled.
+        '''
+        if self.take_prefetched(uri) is not None:
+            metrics.incr('prefetch.discarded')
+
+    def prefetches(self, uri, depth):
+        '''Tells whether page linked at depth is going to be crawled
+           here.
+        '''
+        key = self.canonicalize(uri)
+        return (key not in self.visited and not self.exhausted() and
+                (depth is None or self.scope.allows(key, depth)))
+
+    def remember(self, uri, response, data):
+        self.http_cache.store(uri, response.headers, data)
+
+    def load_css(self, css_uri):
+        '''Returns uris of resources used by stylesheet, resolved relative
+           to it, or None if stylesheet could not be fetched.
+        '''
+        try:
+            (response, css_resource_uris) = self.fetch(css_uri)
+        except FetchError as exc:
+            log('Giving up on {}'.format(exc))
+            return None
+        if css_resource_uris is None:
+            if not response.body:
+                return None
+            # relative to stylesheet after redirects
+            css_resource_uris = [build_uri(u, response.uri)
+                                 for u in find_css_uris(response.body)]
+            self.remember(css_uri, response, css_resource_uris)
+        return [build_uri(u, css_uri) for u in css_resource_uris]
+
+    def css_resources(self, css_uri):
+        return self.css_cache.get_or_create(css_uri,
+                                            lambda: self.load_css(css_uri))
+
+    def robots_allow(self, uri):
+        return not self.respect_robots or self.robots.allows(uri)
+
+    def in_scope(self, uri, depth):
+        if not self.scope.allows(uri, depth):
+            metrics.incr('scope.rejected')
+            return False
+        return self.robots_allow(uri)
+
+    def exhausted(self):
+        return self.scope.exhausted(len(self.visited), self.bytes)
+
+    def enqueue(self, uri, depth=0, target=None):
+        '''Puts canonical uri of page to worklist, page is fetched from
+           target (uri as it was linked), if it is given.
+        '''
+        if not self.in_scope(uri, depth):
+            self.discard(target)
+            return
+        self.frontier.queued(uri, depth, target)
+        self.worklist.put((uri, depth, target or uri))
+
+    def requeue(self, uri, depth, target=None):
+        '''Puts uri, which is already in frontier, back to worklist.'''
+        self.worklist.put((uri, depth, target or uri))
+
+    def done(self, uri, assets, links_to, error=None):
+        metrics.incr('pages')
+        self.frontier.crawled(uri, assets, links_to, error)
+        self.result.put((uri, assets, links_to, error))
+
+    def task_done(self):
+        '''Called when page is crawled or background task finished.'''
+        self.in_flight -= 1
+        if not self.in_flight:
+            # wake up dispatcher, so it can check for termination
+            self.worklist.put(None)
+
+    def spawn(self, func, *args):
+        '''Runs func in background, crawl is not finished until it
+           returns.
+        '''
+        def task():
+            try:
+                func(*args)
+            finally:
+                self.task_done()
+        self.in_flight += 1
+        eventlet.spawn_n(task)
+
+def shard_of(uri, shards):
+    if isinstance(uri, unicode):
+        uri = uri.encode('utf-8')
+    return int(hashlib.md5(uri).hexdigest()[:8], 16) % shards
+
+class ShardedCrawl(Crawl):
+    '''Crawl of single partition of uri space in multi-process mode.
+       Links owned by other shards are sent to their inboxes. `pending` is
+       shared count of uris enqueued, but not processed yet by any shard:
+       crawl is finished when it drops to zero.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.shard = kwargs.pop('shard')
+        self.inboxes = kwargs.pop('inboxes')
+        self.pending = kwargs.pop('pending')
+        super(ShardedCrawl, self).__init__(*args, **kwargs)
+        # do not send the same link to other shard over and over
+        self.sent = VisitedSet()
+
+    def count(self, n):
+        with self.pending.get_lock():
+            self.pending.value += n
+
+    def enqueue(self, uri, depth=0, target=None):
+        if not self.in_scope(uri, depth):
+            self.discard(target)
+            return
+        owner = shard_of(uri, len(self.inboxes))
+        if owner == self.shard:
+            self.count(1)
+            self.frontier.queued(uri, depth, target)
+            self.worklist.put((uri, depth, target or uri))
+        elif uri not in self.sent:
+            self.sent.add(uri)
+            self.count(1)
+            self.inboxes[owner].put((uri, depth, target or uri))
+
+    def requeue(self, uri, depth, target=None):
+        self.count(1)
+        super(ShardedCrawl, self).requeue(uri, depth, target)
+
+    def task_done(self):
+        self.in_flight -= 1
+        self.count(-1)
+
+    def spawn(self, func, *args):
+        self.count(1)
+        super(ShardedCrawl, self).spawn(func, *args)
+
+    def prefetches(self, uri, depth):
+        # pages of other shards are crawled by other processes
+        return (shard_of(self.canonicalize(uri),
+                         len(self.inboxes)) == self.shard and
+                super(ShardedCrawl, self).prefetches(uri, depth))
+
+def crawl_uri(uri, crawl, depth=0, target=None, prefetched=None):
+    '''Crawls page with canonical uri, fetching it from target, unless it
+       is prefetched.
+    '''
+    check_uri = crawl.check_uri
+    target = target or uri
+    log('Crawling {}'.format(target))
+    try:
+        (response, cached) = crawl.fetch_page(target, prefetched)
+    except FetchError as exc:
+        log('Giving up on {}'.format(exc))
+        crawl.done(uri, set(), set(), exc.reason)
+        return
+    if cached is not None:
+        log('{} is not modified'.format(target))
+        links_to = set(cached['links_to'])
+        targets = cached.get('targets', {})
+        for link_uri in links_to:
+            if link_uri not in crawl.visited:
+                crawl.enqueue(link_uri, depth + 1, targets.get(link_uri))
+        crawl.done(uri, set(cached['assets']), links_to)
+        return
+    links = response.body
+    if links is None:
+        log('{} is not html'.format(target))
+        crawl.done(uri, set(), set())
+        return
+    # links are relative to page after redirects
+    base_uri = response.uri
     # find all assets on this page (even external)
     assets = set()
     # js:
-    assets.update(ifilter(check_uri, extract_uris(bs.findAll('script', src=True),
-                                                  'JS', uri)))
+    assets.update(ifilter(check_uri, extract_uris(links['script'],
+                                                  'JS', base_uri)))
     # imgs:
-    assets.update(ifilter(check_uri, extract_uris(bs.findAll('img', src=True),
-                                                  'IMAGE', uri)))
+    assets.update(ifilter(check_uri, extract_uris(links['img'],
+                                                  'IMAGE', base_uri)))
     # css are a bit harder: there could be links to fonts/imgs inside
     # but we will ignore fonts/imgs represented in base64
-    css_elems = bs.findAll('link', href=True, rel="stylesheet")
-    for css_uri in ifilter(check_uri, extract_uris(css_elems, 'CSS',
-                                                   uri, 'href')):
+    for css_uri in ifilter(check_uri, extract_uris(links['stylesheet'], 'CSS',
+                                                   base_uri)):
         assets.add(css_uri)
-        if css_uri in css_cache:
-            full_css_resource_uris = css_cache[css_uri]
-        else:
-            css_body = request(css_uri)
-            if not css_body:
-                continue
-            css_resource_uris = find_css_uris(css_body)
-            full_css_resource_uris = map(lambda u:build_uri(u, uri),
-                                         css_resource_uris)
-            css_cache[css_uri] = full_css_resource_uris
+        full_css_resource_uris = crawl.css_resources(css_uri) or ()
         for full_css_resource_uri in full_css_resource_uris:
             log('{} has - CSS_RESOURCE {}'.format(uri, full_css_resource_uri))
             assets.add(full_css_resource_uri)
-    links_to = set()
-    for link in bs.findAll('a', href=True):
-        href = link.get('href')
-        link_uri = normalize_uri(build_uri(href, uri))
-        if not check_uri(link_uri):
+    # canonical uris of links, keyed by uris as linked
+    candidates = {}
+    seen = set()
+    for href in links['a']:
+        link_target = normalize_uri(build_uri(href, base_uri))
+        if not check_uri(link_target):
             continue
-        if link_uri in links_to:
+        link_uri = crawl.canonicalize(link_target)
+        if link_uri in seen:
             continue
-        headers = head_uri(link_uri)
-        if not headers:
+        seen.add(link_uri)
+        candidates[link_target] = link_uri
+    links_to = set()
+    targets = {}
+    for (link_target, content_type) in crawl.resolver.resolve_many(
+            candidates, depth + 1):
+        if content_type is None:
             continue
+        link_uri = candidates[link_target]
         log('{} has - LINK TO {}'.format(uri, link_uri))
         # do not add pages to some files to worklist
-        if headers['Content-Type'].startswith('text/html'):
+        if is_html(content_type):
             links_to.add(link_uri)
-            if link_uri not in visited:
-                worklist.put(link_uri)
-    result.put((uri, assets, links_to))
+            if link_target != link_uri:
+                targets[link_uri] = link_target
+            if link_uri not in crawl.visited:
+                crawl.enqueue(link_uri, depth + 1, link_target)
+            else:
+                crawl.discard(link_target)
+    crawl.remember(target, response, {'assets': list(assets),
+                                      'links_to': list(links_to),
+                                      'targets': targets})
+    crawl.done(uri, assets, links_to)
+
+def seed_from_sitemaps(crawl, uri):
+    '''Enqueues pages listed in sitemaps of seed uri host: ones named in
+       robots.txt, or /sitemap.xml. Sitemap indexes are followed, up to
+       MAX_SITEMAPS sitemaps in total.
+    '''
+    robots = crawl.robots.get(uri)
+    sitemaps = collections.deque(robots.sitemaps or
+                                 [build_uri('/sitemap.xml', uri)])
+    seen = set(sitemaps)
+    def on_page(loc):
+        if not crawl.check_uri(loc):
+            return
+        page_target = normalize_uri(loc)
+        page_uri = crawl.canonicalize(page_target)
+        if page_uri not in crawl.visited:
+            metrics.incr('sitemaps.pages')
+            # pages from sitemap are linked from seed, so scope applies
+            crawl.enqueue(page_uri, 1, page_target)
+    def on_sitemap(loc):
+        if loc not in seen and len(seen) < MAX_SITEMAPS:
+            seen.add(loc)
+            sitemaps.append(loc)
+    reader = lambda headers: SitemapReader(on_page, on_sitemap)
+    while sitemaps:
+        sitemap_uri = sitemaps.popleft()
+        if not crawl.check_uri(sitemap_uri):
+            continue
+        try:
+            response = fetch('GET', sitemap_uri, crawl.scheduler, crawl.client,
+                             crawl.retry, reader=reader)
+        except FetchError as exc:
+            log('Giving up on sitemap {}'.format(exc))
+            continue
+        except expat.ExpatError as exc:
+            log('Broken sitemap {}: {}'.format(sitemap_uri, exc))
+            continue
+        metrics.incr('sitemaps')
+        log('Sitemap {} has {} locations'.format(sitemap_uri, response.body))
 
-def main(uri, default_scheme='https'):
+def sample_metrics(crawl, pool, stop, out=None, interval=METRICS_INTERVAL):
+    '''Periodically records queue depth and pool occupancy and dumps
+       metrics snapshot to `out` as json line, until stop event is sent.
+    '''
+    while not stop.ready():
+        metrics.gauge('queue', crawl.worklist.qsize())
+        metrics.gauge('in_flight', crawl.in_flight)
+        metrics.gauge('pool_running', pool.running())
+        metrics.gauge('visited', len(crawl.visited))
+        if out is not None:
+            out.write(json.dumps(metrics.snapshot()) + '\n')
+            out.flush()
+        with eventlet.timeout.Timeout(interval, False):
+            stop.wait()
+
+def run(crawl, pool):
+    '''Feeds pool from worklist continuously: new page is crawled as soon as
+       there is free green thread for it. Crawl is finished, when worklist
+       is empty and nothing is in flight.
+    '''
+    def work(uri, depth, target, prefetched):
+        try:
+            crawl_uri(uri, crawl, depth, target, prefetched)
+        finally:
+            crawl.task_done()
+    # initial wake up, worklist could be empty on resume
+    crawl.worklist.put(None)
+    while True:
+        to_work = crawl.worklist.get()
+        # when budget is exhausted, worklist is just drained
+        if (to_work is None or to_work[0] in crawl.visited or
+                crawl.exhausted()):
+            if to_work is not None:
+                crawl.discard(to_work[2])
+            if not crawl.in_flight and crawl.worklist.empty():
+                break
+            continue
+        (uri, depth, target) = to_work
+        crawl.visited.add(uri)
+        crawl.in_flight += 1
+        if len(crawl.visited) % 100 == 0:
+            log('Queue has {} items to crawl, {} in flight'.format(
+                crawl.worklist.qsize(), crawl.in_flight))
+        pool.spawn_n(work, uri, depth, target,
+                     crawl.take_prefetched(target))
+    if crawl.exhausted():
+        log('Crawl budget is exhausted')
+    log('We have visited {} pages in total'.format(len(crawl.visited)))
+
+def run_shard(crawl, pool):
+    '''Same as run, but for ShardedCrawl: also receives uris from other
+       shards and finishes, when nothing is pending in any shard.
+    '''
+    inbox = crawl.inboxes[crawl.shard]
+    def receive():
+        while True:
+            try:
+                (uri, depth, target) = inbox.get_nowait()
+            except Empty:
+                eventlet.sleep(SHARD_POLL)
+                continue
+            crawl.frontier.queued(uri, depth, target)
+            crawl.worklist.put((uri, depth, target))
+    def work(uri, depth, target, prefetched):
+        try:
+            crawl_uri(uri, crawl, depth, target, prefetched)
+        finally:
+            crawl.task_done()
+    receiver = eventlet.spawn(receive)
+    while True:
+        try:
+            to_work = crawl.worklist.get(timeout=SHARD_POLL)
+        except eventlet.queue.Empty:
+            if not crawl.pending.value:
+                break
+            continue
+        (uri, depth, target) = to_work
+        if uri in crawl.visited or crawl.exhausted():
+            crawl.discard(target)
+            crawl.count(-1)
+            continue
+        crawl.visited.add(uri)
+        crawl.in_flight += 1
+        pool.spawn_n(work, uri, depth, target,
+                     crawl.take_prefetched(target))
+    receiver.kill()
+    log('Shard {} has visited {} pages in total'.format(crawl.shard,
+                                                       len(crawl.visited)))
+
+
+def build_crawl(uri, default_scheme='https', frontier_path=None, resume=False,
+                http_cache_path=None, concurrency=HOST_CONCURRENCY,
+                rate=HOST_RATE, attempts=ATTEMPTS, strip_params=STRIP_PARAMS,
+                strip_trailing_slash=True, max_depth=None, max_pages=None,
+                max_bytes=None, include=(), exclude=(), prefixes=(),
+                max_repeats=MAX_SEGMENT_REPEATS, max_body_size=MAX_BODY_SIZE,
+                robots=True, sitemaps=False, shares=1, crawl_class=Crawl,
+                **kwargs):
+    '''Returns normalized seed uri and crawl state for it.'''
+    canonicalize = make_canonicalizer(strip_params, strip_trailing_slash)
     uri = normalize_uri(uri, default_scheme)
-    parsed_uri = urlparse.urlsplit(uri)
-    netloc = parsed_uri.netloc
+    netloc = urlparse.urlsplit(canonicalize(uri)).netloc
     check_uri = make_uri_checker(netloc)
+    crawl = crawl_class(check_uri, canonicalize,
+                        Frontier(frontier_path, resume),
+                        HostScheduler(concurrency, rate, shares=shares),
+                        HTTPClient(max_body_size=max_body_size),
+                        RetryPolicy(attempts), HTTPCache(http_cache_path),
+                        Scope(max_depth, max_pages, max_bytes, include,
+                              exclude, prefixes, max_repeats),
+                        robots=robots, sitemaps=sitemaps, **kwargs)
+    return uri, crawl
+
+def start(crawl, uri):
+    crawl.enqueue(crawl.canonicalize(uri), 0, uri)
+    if crawl.sitemaps:
+        crawl.spawn(seed_from_sitemaps, crawl, uri)
 
-    visited = set()
-    css_cache = {}
+def restore(crawl, uri, resume, seed=True):
+    '''Restores crawl state from frontier on resume, otherwise starts
+       from seed uri (and its sitemaps, if crawl uses them).
+    '''
+    frontier = crawl.frontier
+    if resume and frontier.path:
+        (crawled, pending) = frontier.load()
+        log('Resuming: {} pages crawled, {} pending'.format(len(crawled),
+                                                           len(pending)))
+        for (crawled_uri, (assets, links_to, error)) in crawled.iteritems():
+            crawl.visited.add(crawled_uri)
+            crawl.result.put((crawled_uri, assets, links_to, error))
+        for (pending_uri, depth, target) in pending:
+            crawl.requeue(pending_uri, depth, target)
+        if seed and not crawled and not pending:
+            start(crawl, uri)
+    elif seed:
+        start(crawl, uri)
 
-    worklist = eventlet.Queue()
-    result = eventlet.Queue()
+def execute(crawl, metrics_stream=None, runner=run):
     pool = eventlet.GreenPool(POOL_SIZE)
-    worklist.put(uri)
+    metrics.reset()
+    stop = eventlet.event.Event()
+    sampler = eventlet.spawn(sample_metrics, crawl, pool, stop, metrics_stream)
+    runner(crawl, pool)
+    # killing sampler is not safe, if it has not started yet
+    stop.send()
+    sampler.wait()
+    if metrics_stream is not None:
+        metrics_stream.write(json.dumps(dict(metrics.snapshot(), final=True))
+                             + '\n')
+        metrics_stream.flush()
+    metrics.log_summary()
+    crawl.frontier.close()
+    crawl.http_cache.close()
+
+def main(uri, resume=False, report_stream=None, metrics_stream=None,
+         **options):
+    '''Crawls site starting from uri. Returns report as dict, unless
+       report_stream is provided: then pages are written to it as json lines
+       while crawling and nothing is returned. See build_crawl for options.
+    '''
+    (uri, crawl) = build_crawl(uri, resume=resume, **options)
+    if report_stream is not None:
+        consumer = eventlet.spawn(stream_report, crawl.result, report_stream)
+    restore(crawl, uri, resume)
+    execute(crawl, metrics_stream)
+    if report_stream is not None:
+        crawl.result.put(None)
+        consumer.wait()
+        return None
+    res = {}
+    for (uri, assets, new_uris, error) in drain_queue(crawl.result):
+        res[uri] = report_record(assets, new_uris, error)
+    return res
+
+def shard_path(path, shard):
+    return '{}.{}'.format(path, shard) if path else path
+
+def forward_results(result, results):
     while True:
-        log('Queue has {} items to crawl'.format(worklist.qsize()))
-        while not worklist.empty():
-            to_work = worklist.get()
-            if to_work in visited:
-                continue
-            visited.add(to_work)
-            pool.spawn_n(crawl_uri, to_work, check_uri,
-                         css_cache, visited, worklist, result)
-        pool.waitall()
-        log('We have {} results in total'.format(result.qsize()))
-        if worklist.empty():
+        item = result.get()
+        if item is None:
             break
+        (uri, assets, links_to, error) = item
+        results.put((uri, list(assets), list(links_to), error))
+
+def crawl_shard(shard, inboxes, pending, results, uri, resume, metrics_path,
+                options):
+    '''Entry point of worker process in multi-process mode.'''
+    options = dict(options,
+                   frontier_path=shard_path(options.get('frontier_path'),
+                                            shard),
+                   http_cache_path=shard_path(options.get('http_cache_path'),
+                                              shard))
+    metrics_stream = None
+    if metrics_path:
+        metrics_stream = open(shard_path(metrics_path, shard), 'w')
+    (uri, crawl) = build_crawl(uri, resume=resume, shares=len(inboxes),
+                               crawl_class=ShardedCrawl, shard=shard,
+                               inboxes=inboxes, pending=pending, **options)
+    forwarder = eventlet.spawn(forward_results, crawl.result, results)
+    restore(crawl, uri, resume, seed=(shard == 0))
+    # every shard holds one pending item until it is restored,
+    # so nobody finishes before all shards started
+    crawl.count(-1)
+    execute(crawl, metrics_stream, run_shard)
+    crawl.result.put(None)
+    forwarder.wait()
+    results.put(None)
+
+def main_sharded(uri, processes, resume=False, report_stream=None,
+                 metrics_path=None, **options):
+    '''Same as main, but crawls with `processes` worker processes, each
+       owning partition of uris by hash. Resuming requires the same number
+       of processes as interrupted crawl had. Page and byte budgets are
+       split evenly between processes, as well as concurrency and rate per
+       host (see HostScheduler), since every process crawls the same hosts.
+    '''
+    for budget in ('max_pages', 'max_bytes'):
+        if options.get(budget) is not None:
+            options[budget] = -(-options[budget] // processes)
+    inboxes = [multiprocessing.Queue() for _ in range(processes)]
+    pending = multiprocessing.Value(b'l', processes)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=crawl_shard,
+                                       args=(shard, inboxes, pending, results,
+                                             uri, resume, metrics_path,
+                                             options))
+               for shard in range(processes)]
+    for worker in workers:
+        worker.start()
     res = {}
-    for (uri, assets, new_uris) in drain_queue(result):
-        res[uri] = {
-            'assets': list(assets),
-            'links_to': list(new_uris)
+    finished = 0
+    while finished < processes:
+        try:
+            item = results.get(timeout=1)
+        except Empty:
+            if not any(worker.is_alive() for worker in workers):
+                log('Worker processes died, report is incomplete')
+                break
+            continue
+        if item is None:
+            finished += 1
+        elif report_stream is not None:
+            write_report_line(report_stream, item)
+        else:
+            (page_uri, assets, links_to, error) = item
+            res[page_uri] = report_record(assets, links_to, error)
+    for worker in workers:
+        worker.join()
+    return None if report_stream is not None else res
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Simple web crawler.')
+    parser.add_argument('uri')
+    parser.add_argument('report', help='path to json report')
+    parser.add_argument('--jsonl', action='store_true',
+                        help='stream report as json lines while crawling')
+    parser.add_argument('--concurrency', type=int, default=HOST_CONCURRENCY,
+                        help='initial number of concurrent requests per host')
+    parser.add_argument('--rate', type=float, default=HOST_RATE,
+                        help='max requests per second per host, 0 - no limit')
+    parser.add_argument('--attempts', type=int, default=ATTEMPTS,
+                        help='attempts per request for transient failures')
+    parser.add_argument('--http-cache', metavar='PATH',
+                        help='keep validators and extracted links in this '
+                             'file to recrawl unchanged pages cheaply')
+    parser.add_argument('--strip-param', metavar='PATTERN', action='append',
+                        dest='strip_params',
+                        help='ignore query parameter matching shell pattern, '
+                             'can be repeated (default: {})'.format(
+                                 ' '.join(STRIP_PARAMS)))
+    parser.add_argument('--keep-trailing-slash', action='store_true',
+                        help='treat /path and /path/ as different pages')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='dump metrics snapshots to this file')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of crawling processes')
+    parser.add_argument('--max-depth', type=int,
+                        help='max number of links from seed uri')
+    parser.add_argument('--max-pages', type=int,
+                        help='stop after crawling this many pages')
+    parser.add_argument('--max-bytes', type=int,
+                        help='stop after downloading this many bytes')
+    parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE,
+                        help='do not download responses larger than this '
+                             'many bytes')
+    parser.add_argument('--ignore-robots', action='store_true',
+                        help='do not obey robots.txt')
+    parser.add_argument('--sitemaps', action='store_true',
+                        help='crawl pages listed in sitemaps of seed host')
+    parser.add_argument('--include', metavar='REGEXP', action='append',
+                        help='crawl only uris matching any of these')
+    parser.add_argument('--exclude', metavar='REGEXP', action='append',
+                        help='do not crawl uris matching any of these')
+    parser.add_argument('--prefix', metavar='PATH', action='append',
+                        dest='prefixes',
+                        help='crawl only paths starting with any of these')
+    parser.add_argument('--max-repeats', type=int,
+                        default=MAX_SEGMENT_REPEATS,
+                        help='skip paths repeating segment more times, '
+                             '0 - no trap detection')
+    parser.add_argument('--frontier', metavar='PATH',
+                        help='journal crawl progress to this file')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue crawl journaled in --frontier file')
+    args = parser.parse_args(argv)
+    if args.strip_params is None:
+        args.strip_params = STRIP_PARAMS
+    if args.resume and not args.frontier:
+        parser.error('--resume requires --frontier')
+    return args
+
+def fold_main(argv):
+    if len(argv) != 2:
+        log('Usage {} fold report.jsonl report.json'.format(sys.argv[0]))
+        sys.exit(1)
+    (src, dst) = argv
+    try:
+        with open(src) as f:
+            report = fold_report(f)
+        with open(dst, 'w') as f:
+            json.dump(report, f, indent=4)
+    except Exception:
+        log_exc('Error while folding report {} to {}'.format(src, dst))
+        sys.exit(1)
+
+
+class TestRobots(unittest.TestCase):
+    def test_groups(self):
+        text = '\n'.join([
+            'User-agent: *',
+            'Disallow: /private',
+            'Crawl-delay: 2',
+            '',
+            'User-agent: other',
+            'User-agent: Crawler  # our group',
+            'Disallow: /',
+            'Allow: /public',
+            'Crawl-delay: 0.5',
+            'Sitemap: http://example.com/sitemap.xml'])
+        robots = Robots.parse(text)
+        self.assertFalse(robots.allows('/private2'))
+        self.assertTrue(robots.allows('/public/page'))
+        self.assertEqual(robots.delay, 0.5)
+        self.assertEqual(robots.sitemaps, ['http://example.com/sitemap.xml'])
+        # other agents get * group
+        robots = Robots.parse(text, 'bot/1.0')
+        self.assertTrue(robots.allows('/'))
+        self.assertFalse(robots.allows('/private'))
+        self.assertEqual(robots.delay, 2)
+
+    def test_empty_agent(self):
+        robots = Robots.parse('User-agent:\nDisallow: /\n\n'
+                              'User-agent: *\nDisallow: /private\n')
+        self.assertTrue(robots.allows('/'))
+        self.assertFalse(robots.allows('/private'))
+
+    def test_patterns(self):
+        robots = Robots.parse('User-agent: *\nDisallow: /*.pdf$\n'
+                              'Disallow: /a\nAllow: /a/b\nAllow: /c\n'
+                              'Disallow: /c\n')
+        specs = {
+            '/file.pdf': False,
+            '/file.pdf?x=1': True,
+            '/a/c': False,
+            '/a/b/c': True,
+            # allow wins on tie
+            '/c': True,
+            '/': True
         }
-    return res
+        for (path, answer) in specs.items():
+            self.assertEqual(robots.allows(path), answer, path)
+
+class TestCanonicalizer(unittest.TestCase):
+    def test_canonicalize(self):
+        canonicalize = make_canonicalizer()
+        specs = {
+            'HTTP://Example.COM:80/a/': 'http://example.com/a',
+            'https://example.com:443': 'https://example.com/',
+            'http://example.com/%7euser/%2f': 'http://example.com/~user/%2F',
+            'http://example.com/p?b=2&utm_source=x&a=1':
+                'http://example.com/p?a=1&b=2',
+            'http://example.com/p;jsessionid=1;v=2':
+                'http://example.com/p;v=2',
+            'http://example.com/?SID=1': 'http://example.com/'
+        }
+        for (uri, answer) in specs.items():
+            self.assertEqual(canonicalize(uri), answer)
+
+    def test_options(self):
+        canonicalize = make_canonicalizer(strip_params=(),
+                                          strip_trailing_slash=False)
+        self.assertEqual(canonicalize('http://example.com/a/?utm_x=1'),
+                         'http://example.com/a/?utm_x=1')
+
+class TestVisitedSet(unittest.TestCase):
+    def test_membership(self):
+        visited = VisitedSet(batch=4)
+        uris = ['http://example.com/{}'.format(i) for i in range(100)]
+        for uri in uris:
+            visited.add(uri)
+            visited.add(uri)
+        self.assertEqual(len(visited), len(uris))
+        # most fingerprints are merged into sorted array
+        self.assertGreater(len(visited.fingerprints), len(visited.recent))
+        for uri in uris:
+            self.assertIn(uri, visited)
+        self.assertNotIn('http://example.com/100', visited)
+
+class TestScope(unittest.TestCase):
+    def test_allows(self):
+        scope = Scope(max_depth=2, include=['example'], exclude=[r'\.php'],
+                      prefixes=['/docs', '/blog'], max_repeats=2)
+        specs = [
+            ('http://other.com/', 0, True),
+            ('http://example.com/docs/a', 2, True),
+            ('http://example.com/docs/a', 3, False),
+            ('http://example.com/shop/a', 1, False),
+            ('http://other.com/docs/a', 1, False),
+            ('http://example.com/docs/a.php', 1, False),
+            ('http://example.com/docs/a/a/a', 1, False)
+        ]
+        for (uri, depth, answer) in specs:
+            self.assertEqual(scope.allows(uri, depth), answer, uri)
+
+    def test_exhausted(self):
+        scope = Scope(max_pages=10, max_bytes=1000)
+        self.assertFalse(scope.exhausted(9, 999))
+        self.assertTrue(scope.exhausted(10, 0))
+        self.assertTrue(scope.exhausted(0, 1000))
+        self.assertFalse(Scope().exhausted(10 ** 6, 10 ** 9))
+
+class TestFindCssUris(unittest.TestCase):
+    def test_find(self):
+        css = '''
+            @import "base.css";
+            @import 'print.css' print;
+            .a { background: url(img/a.png) }
+            .b { background: url( "img/b.png" ) }
+            .c { background: url('img/c.png') }
+            .d { background: url(data:image/png;base64,AAAA) }
+            @font-face { src: url(font.woff) format("woff") }
+        '''
+        self.assertEqual(find_css_uris(css),
+                         ['base.css', 'print.css', 'img/a.png', 'img/b.png',
+                          'img/c.png', 'font.woff'])
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        log('Usage {} uri report.json'.format(sys.argv[0]))
-        sys.exit(1)
+    if sys.argv[1:] == ['--test']:
+        unittest.main(argv=sys.argv[:1])
+        sys.exit(0)
+    if sys.argv[1:2] == ['fold']:
+        fold_main(sys.argv[2:])
+        sys.exit(0)
+    args = parse_args(sys.argv[1:])
+    options = dict(frontier_path=args.frontier,
+                   resume=args.resume,
+                   concurrency=args.concurrency,
+                   rate=args.rate,
+                   attempts=args.attempts,
+                   http_cache_path=args.http_cache,
+                   strip_params=args.strip_params,
+                   strip_trailing_slash=not args.keep_trailing_slash,
+                   max_depth=args.max_depth,
+                   max_pages=args.max_pages,
+                   max_bytes=args.max_bytes,
+                   include=args.include,
+                   exclude=args.exclude,
+                   prefixes=args.prefixes,
+                   max_repeats=args.max_repeats,
+                   max_body_size=args.max_body_size,
+                   robots=not args.ignore_robots,
+                   sitemaps=args.sitemaps)
+    if args.processes > 1:
+        crawl_site = functools.partial(main_sharded, args.uri, args.processes,
+                                       metrics_path=args.metrics)
     else:
-        report = main(sys.argv[1])
-        try:
-            with open(sys.argv[2], 'w') as f:
+        metrics_stream = open(args.metrics, 'w') if args.metrics else None
+        crawl_site = functools.partial(main, args.uri,
+                                       metrics_stream=metrics_stream)
+    try:
+        if args.jsonl:
+            with open(args.report, 'w') as f:
+                crawl_site(report_stream=f, **options)
+        else:
+            report = crawl_site(**options)
+            with open(args.report, 'w') as f:
                 json.dump(report, f, indent=4)
-        except Exception:
-            log_exc('Error while writing report to {}'.format(sys.argv[2]))
-            sys.exit(1)
+    except Exception:
+        log_exc('Error while writing report to {}'.format(args.report))
+        sys.exit(1)
@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Asyncio engine for the web crawler (see crawler.py), for python3.
+# It has the same `main(uri)` contract and report format, and extracts
+# pages the same way crawl_uri does: same-domain scripts, images,
+# stylesheets and resources referenced from them count as assets, links are
+# followed only if they point to html. Content type is guessed from extension
+# or HEAD-requested once per uri, stylesheets are fetched once per crawl.
+# Only the standard library is required: http client is implemented on top of
+# asyncio streams and keeps connections alive. If uvloop is installed it can
+# be used as event loop (--loop uvloop).
+# Bodies larger than --max-body-size (10 MiB by default, also after
+# decompression) are reported as errors, bodies which are not html are not
+# parsed for links.
+# robots.txt is NOT honoured: neither disallowed paths nor crawl-delay, so
+# crawl only own sites or benchmark sites with it. robots.txt, journaling,
+# http cache, scoping, rate limits and multi-process mode are only available
+# in crawler.py.
+
+import re
+import sys
+import json
+import zlib
+import random
+import string
+import asyncio
+import fnmatch
+import logging
+import argparse
+import mimetypes
+import posixpath
+import collections
+
+from html.parser import HTMLParser
+from urllib.parse import urlsplit, urlunsplit, urljoin
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+WORKERS = 256
+HOST_CONCURRENCY = 16
+TIMEOUT = 20
+ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+MAX_REDIRECTS = 5
+# bodies are read in chunks of CHUNK_SIZE bytes, larger than MAX_BODY_SIZE
+# bytes (after decompression too) are not downloaded
+CHUNK_SIZE = 64 * 1024
+MAX_BODY_SIZE = 10 * 1024 * 1024
+CONTENT_TYPE_CACHE_SIZE = 100000
+CSS_CACHE_SIZE = 10000
+# extensions which say nothing about content type of response
+DYNAMIC_EXTENSIONS = frozenset(['', '.php', '.asp', '.aspx', '.jsp', '.cgi',
+                                '.pl', '.py', '.do', '.action'])
+# query and path parameters which do not change page, shell patterns
+STRIP_PARAMS = ('utm_*', 'jsessionid', 'phpsessid', 'aspsessionid*',
+                'sessionid', 'sid')
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+UNRESERVED = frozenset(string.ascii_letters + string.digits + '-._~')
+CSS_URI_RE = re.compile(r'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^)'"\s]*))\s*\)'''
+                        r'''|@import\s+(?:"([^"]*)"|'([^']*)')''', re.I)
+
+log = logging.getLogger('crawler_aio').info
+
+
+def find_css_uris(css):
+    '''Catches url, such as background-url or font-url, and @imports inside
+       CSS stylesheets. Inline data: uris are skipped.
+    '''
+    uris = []
+    for groups in CSS_URI_RE.findall(css):
+        uri = ''.join(groups).strip()
+        if uri and not uri.lower().startswith('data:'):
+            uris.append(uri)
+    return uris
+
+def normalize_uri(uri, default_scheme='https'):
+    '''Tries to normalize uris, so //example.com becomes https://example.com,
+       www.example.com -- https://example.com and so on.
+    '''
+    parsed = urlsplit(uri)
+    if parsed.netloc:
+        netloc = parsed.netloc
+        path = parsed.path
+    else:
+        (netloc, sep, path) = parsed.path.partition('/')
+        if not netloc:
+            raise ValueError('Cannot normalize relative uri {}'.format(uri))
+        path = sep + path
+    return urlunsplit((parsed.scheme or default_scheme, netloc, path,
+                       parsed.query, ''))
+
+def normalize_escapes(part):
+    def replace(match):
+        char = chr(int(match.group(1), 16))
+        if char in UNRESERVED:
+            return char
+        return '%' + match.group(1).upper()
+    return re.sub('%([0-9A-Fa-f]{2})', replace, part)
+
+def canonical_netloc(scheme, netloc):
+    netloc = netloc.lower()
+    default_port = DEFAULT_PORTS.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return netloc
+
+def make_canonicalizer(strip_params=STRIP_PARAMS, strip_trailing_slash=True):
+    '''Same as crawler.make_canonicalizer.'''
+    strip_re = re.compile('|'.join(fnmatch.translate(p.lower())
+                                   for p in strip_params) or '$^')
+    def kept(param):
+        name = param.partition('=')[0]
+        return not strip_re.match(normalize_escapes(name).lower())
+    def canonicalize(uri):
+        parsed = urlsplit(uri)
+        scheme = parsed.scheme.lower()
+        (path, _, params) = parsed.path.partition(';')
+        path = normalize_escapes(path) or '/'
+        if strip_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        params = [p for p in params.split(';') if p and kept(p)]
+        if params:
+            path = ';'.join([path] + params)
+        query = sorted(normalize_escapes(p) for p in parsed.query.split('&')
+                       if p and kept(p))
+        return urlunsplit((scheme, canonical_netloc(scheme, parsed.netloc),
+                           path, '&'.join(query), ''))
+    return canonicalize
+
+def build_uri(uri, base_uri):
+    return urljoin(base_uri, uri)
+
+def make_uri_checker(netloc):
+    '''Creates checker function that limits uri to specified netloc
+       and also ignores #anchors.
+    '''
+    def checker(uri):
+        # ignore empty uri and anchors
+        if not uri or uri.startswith('#'):
+            return False
+        parsed_uri = urlsplit(normalize_uri(uri))
+        return canonical_netloc(parsed_uri.scheme, parsed_uri.netloc) == netloc
+    return checker
+
+def decode_text(body):
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        return body.decode('latin-1')
+
+def decompress(body, wbits, max_size):
+    decompressor = zlib.decompressobj(wbits)
+    data = decompressor.decompress(body, max_size + 1)
+    if len(data) > max_size:
+        raise BodyTooLarge('more than {}'.format(max_size))
+    if not decompressor.eof:
+        raise zlib.error('incomplete or truncated stream')
+    return data
+
+def decode_body(body, encoding, max_size=MAX_BODY_SIZE):
+    if encoding == 'gzip':
+        return decompress(body, 16 + zlib.MAX_WBITS, max_size)
+    elif encoding == 'deflate':
+        try:
+            return decompress(body, zlib.MAX_WBITS, max_size)
+        except zlib.error:
+            # some servers send raw deflate stream without zlib header
+            return decompress(body, -zlib.MAX_WBITS, max_size)
+    return body
+
+def is_html(content_type):
+    '''Missing content type is taken for html, as crawler.py does.'''
+    return not content_type or content_type.startswith('text/html')
+
+
+class LinkExtractor(HTMLParser):
+    '''Collects uris of scripts, images, stylesheets and anchors in single
+       pass over html.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.links = collections.defaultdict(list)
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ('script', 'img', 'link', 'a'):
+            return
+        attrs = dict(attrs)
+        if tag in ('script', 'img'):
+            if attrs.get('src') is not None:
+                self.links[tag].append(attrs['src'])
+        elif tag == 'link':
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'stylesheet' in rel and attrs.get('href') is not None:
+                self.links['stylesheet'].append(attrs['href'])
+        elif attrs.get('href') is not None:
+            self.links['a'].append(attrs['href'])
+
+def extract_links(body):
+    parser = LinkExtractor()
+    parser.feed(decode_text(body))
+    parser.close()
+    return parser.links
+
+
+class HTTPError(Exception):
+    def __init__(self, uri, code, headers):
+        super().__init__('HTTP {} for {}'.format(code, uri))
+        self.code = code
+        self.headers = headers
+
+class BodyTooLarge(Exception):
+    pass
+
+class FetchError(Exception):
+    def __init__(self, uri, reason, transient):
+        super().__init__('{}: {}'.format(uri, reason))
+        self.uri = uri
+        self.reason = reason
+        self.transient = transient
+
+Response = collections.namedtuple('Response', 'status uri headers body')
+
+class HTTPClient:
+    '''Minimal HTTP/1.1 client over asyncio streams. Keeps up to `size`
+       keep-alive connections per host, follows redirects and raises
+       HTTPError for error statuses and BodyTooLarge for bodies larger than
+       max_body_size.
+    '''
+    def __init__(self, size=HOST_CONCURRENCY, max_body_size=MAX_BODY_SIZE):
+        self.size = size
+        self.max_body_size = max_body_size
+        self.idle = collections.defaultdict(list)
+        self.semaphores = {}
+
+    def semaphore(self, key):
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.BoundedSemaphore(self.size)
+        return self.semaphores[key]
+
+    async def connect(self, scheme, netloc):
+        (host, _, port) = netloc.partition(':')
+        port = int(port) if port else (443 if scheme == 'https' else 80)
+        return await asyncio.open_connection(
+            host, port, ssl=True if scheme == 'https' else None)
+
+    async def read_body(self, reader, method, version, status, headers):
+        '''Returns (body, keep_alive).'''
+        connection = headers.get('connection', '').lower()
+        if version == b'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            return b'', keep_alive
+        max_size = self.max_body_size
+        chunks = []
+        total = 0
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    # trailers end with empty line
+                    while (await reader.readline()).strip():
+                        pass
+                    return b''.join(chunks), keep_alive
+                total += size
+                if total > max_size:
+                    raise BodyTooLarge('more than {}'.format(max_size))
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            if length > max_size:
+                raise BodyTooLarge(length)
+            return await reader.readexactly(length), keep_alive
+        # body until connection is closed
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks), False
+            total += len(chunk)
+            if total > max_size:
+                raise BodyTooLarge('more than {}'.format(max_size))
+            chunks.append(chunk)
+
+    async def exchange(self, conn, method, netloc, target, headers):
+        (reader, writer) = conn
+        lines = ['{} {} HTTP/1.1'.format(method, target),
+                 'Host: {}'.format(netloc),
+                 'Accept-Encoding: gzip, deflate']
+        lines.extend('{}: {}'.format(k, v) for (k, v) in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        (version, status) = status_line.split()[:2]
+        status = int(status)
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            (name, _, value) = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        (body, keep_alive) = await self.read_body(reader, method, version,
+                                                  status, response_headers)
+        return status, response_headers, body, keep_alive
+
+    async def perform(self, key, method, target, headers):
+        async with self.semaphore(key):
+            idle = self.idle[key]
+            reused = bool(idle)
+            conn = idle.pop() if reused else await self.connect(*key)
+            try:
+                result = await self.exchange(conn, method, key[1], target,
+                                             headers)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                conn[1].close()
+                if not reused:
+                    raise
+                # server closed idle connection, try once with fresh one
+                conn = await self.connect(*key)
+                try:
+                    result = await self.exchange(conn, method, key[1],
+                                                 target, headers)
+                except BaseException:
+                    conn[1].close()
+                    raise
+            except BaseException:
+                # timeouts and cancellation leave connection in unknown state
+                conn[1].close()
+                raise
+            if result[3]:
+                idle.append(conn)
+            else:
+                conn[1].close()
+        return result
+
+    async def request(self, method, uri, headers=None):
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlsplit(uri)
+            target = urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+            (status, response_headers, body, _) = await self.perform(
+                (parsed.scheme, parsed.netloc), method, target, headers or {})
+            location = response_headers.get('location')
+            if status in (301, 302, 303, 307, 308) and location:
+                uri = build_uri(location, uri)
+                continue
+            if status >= 400:
+                raise HTTPError(uri, status, response_headers)
+            body = decode_body(body, response_headers.get('content-encoding'),
+                               self.max_body_size)
+            return Response(status, uri, response_headers, body)
+        raise HTTPError(uri, status, response_headers)
+
+    def close(self):
+        for conns in self.idle.values():
+            for (_, writer) in conns:
+                writer.close()
+        self.idle.clear()
+
+
+class SingleFlightCache:
+    '''LRU cache where concurrent misses of the same key are computed once.'''
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+
+    async def get_or_create(self, key, create):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if key in self.in_flight:
+            return await asyncio.shield(self.in_flight[key])
+        loop = asyncio.get_running_loop()
+        future = self.in_flight[key] = loop.create_future()
+        value = None
+        try:
+            value = await create()
+            if value is not None:
+                self.entries[key] = value
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        finally:
+            del self.in_flight[key]
+            future.set_result(value)
+        return value
+
+
+class Crawl:
+    '''State of single crawl, shared by all workers.'''
+    def __init__(self, check_uri, canonicalize, client, attempts):
+        self.check_uri = check_uri
+        self.canonicalize = canonicalize
+        self.client = client
+        self.attempts = attempts
+        self.content_types = SingleFlightCache(CONTENT_TYPE_CACHE_SIZE)
+        self.css_cache = SingleFlightCache(CSS_CACHE_SIZE)
+        self.visited = set()
+        self.worklist = asyncio.Queue()
+        self.report = {}
+
+    async def attempt(self, method, uri):
+        try:
+            return await asyncio.wait_for(self.client.request(method, uri),
+                                          TIMEOUT)
+        except asyncio.TimeoutError:
+            raise FetchError(uri, 'timeout', True)
+        except HTTPError as exc:
+            transient = exc.code in (408, 429) or exc.code >= 500
+            raise FetchError(uri, 'HTTP {}'.format(exc.code), transient)
+        except BodyTooLarge as exc:
+            raise FetchError(uri, 'body too large: {} bytes'.format(exc),
+                             False)
+        except zlib.error as exc:
+            raise FetchError(uri, 'bad content encoding: {}'.format(exc),
+                             False)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as exc:
+            raise FetchError(uri, '{}: {}'.format(type(exc).__name__, exc),
+                             True)
+
+    async def fetch(self, method, uri):
+        '''Performs request, retrying transient failures with exponential
+           backoff. Raises FetchError when request finally failed.
+        '''
+        for n in range(self.attempts):
+            try:
+                return await self.attempt(method, uri)
+            except FetchError as exc:
+                if not exc.transient or n == self.attempts - 1:
+                    raise
+                delay = random.uniform(0, min(BACKOFF_CAP,
+                                              BACKOFF_BASE * 2 ** n))
+                log('Retrying {} {} in {:.1f}s: {}'.format(method, uri, delay,
+                                                          exc.reason))
+                await asyncio.sleep(delay)
+
+    def guess_content_type(self, uri):
+        path = urlsplit(uri).path
+        if posixpath.splitext(path)[1].lower() in DYNAMIC_EXTENSIONS:
+            return None
+        return mimetypes.guess_type(path)[0]
+
+    async def content_type(self, uri):
+        guessed = self.guess_content_type(uri)
+        if guessed:
+            return guessed
+        async def head():
+            try:
+                response = await self.fetch('HEAD', uri)
+            except FetchError as exc:
+                log('Error, while requesting {}'.format(exc))
+                return None
+            return response.headers.get('content-type', '')
+        return await self.content_types.get_or_create(uri, head)
+
+    async def css_resources(self, css_uri):
+        async def load():
+            try:
+                response = await self.fetch('GET', css_uri)
+            except FetchError as exc:
+                log('Giving up on {}'.format(exc))
+                return None
+            # relative to stylesheet after redirects
+            return [build_uri(u, response.uri)
+                    for u in find_css_uris(decode_text(response.body))]
+        return await self.css_cache.get_or_create(css_uri, load)
+
+    def enqueue(self, uri, target=None):
+        '''Puts canonical uri of page to worklist, page is fetched from
+           target (uri as it was linked), if it is given.
+        '''
+        self.worklist.put_nowait((uri, target or uri))
+
+    def done(self, uri, assets, links_to, error=None):
+        record = {'assets': list(assets), 'links_to': list(links_to)}
+        if error is not None:
+            record['error'] = error
+        self.report[uri] = record
+
+def extract_uris(values, type_, base_uri):
+    for value in values:
+        value_uri = build_uri(value, base_uri)
+        log('{} has - {}: {}'.format(base_uri, type_, value_uri))
+        yield value_uri
+
+async def crawl_uri(uri, crawl, target=None):
+    '''Crawls page with canonical uri, fetching it from target.'''
+    check_uri = crawl.check_uri
+    target = target or uri
+    log('Crawling {}'.format(target))
+    try:
+        response = await crawl.fetch('GET', target)
+    except FetchError as exc:
+        log('Giving up on {}'.format(exc))
+        crawl.done(uri, (), (), exc.reason)
+        return
+    if (not response.body or
+            not is_html(response.headers.get('content-type'))):
+        log('{} is not html'.format(target))
+        crawl.done(uri, (), ())
+        return
+    links = extract_links(response.body)
+    # links are relative to page after redirects
+    base_uri = response.uri
+    assets = set()
+    assets.update(filter(check_uri, extract_uris(links['script'], 'JS',
+                                                 base_uri)))
+    assets.update(filter(check_uri, extract_uris(links['img'], 'IMAGE',
+                                                 base_uri)))
+    css_uris = list(filter(check_uri, extract_uris(links['stylesheet'], 'CSS',
+                                                   base_uri)))
+    assets.update(css_uris)
+    for resources in await asyncio.gather(*map(crawl.css_resources,
+                                               css_uris)):
+        for resource_uri in resources or ():
+            log('{} has - CSS_RESOURCE {}'.format(uri, resource_uri))
+            assets.add(resource_uri)
+    # (canonical uri, uri as linked) of links
+    candidates = []
+    seen = set()
+    for href in links['a']:
+        link_target = normalize_uri(build_uri(href, base_uri))
+        if not check_uri(link_target):
+            continue
+        link_uri = crawl.canonicalize(link_target)
+        if link_uri not in seen:
+            seen.add(link_uri)
+            candidates.append((link_uri, link_target))
+    content_types = await asyncio.gather(*(crawl.content_type(link_target)
+                                           for (_, link_target) in candidates))
+    links_to = set()
+    for ((link_uri, link_target), content_type) in zip(candidates,
+                                                       content_types):
+        if content_type is None:
+            continue
+        log('{} has - LINK TO {}'.format(uri, link_uri))
+        # do not add pages to some files to worklist
+        if content_type.startswith('text/html'):
+            links_to.add(link_uri)
+            if link_uri not in crawl.visited:
+                crawl.enqueue(link_uri, link_target)
+    crawl.done(uri, assets, links_to)
+
+async def worker(crawl):
+    while True:
+        (uri, target) = await crawl.worklist.get()
+        try:
+            if uri not in crawl.visited:
+                crawl.visited.add(uri)
+                await crawl_uri(uri, crawl, target)
+        except Exception:
+            logging.exception('Error while crawling {}'.format(uri))
+        finally:
+            crawl.worklist.task_done()
+
+async def crawl_site(uri, default_scheme='https', workers=WORKERS,
+                     concurrency=HOST_CONCURRENCY, attempts=ATTEMPTS,
+                     strip_params=STRIP_PARAMS, strip_trailing_slash=True,
+                     max_body_size=MAX_BODY_SIZE):
+    canonicalize = make_canonicalizer(strip_params, strip_trailing_slash)
+    uri = normalize_uri(uri, default_scheme)
+    netloc = urlsplit(canonicalize(uri)).netloc
+    client = HTTPClient(concurrency, max_body_size)
+    crawl = Crawl(make_uri_checker(netloc), canonicalize, client, attempts)
+    crawl.enqueue(canonicalize(uri), uri)
+    tasks = [asyncio.create_task(worker(crawl)) for _ in range(workers)]
+    # every enqueued uri is marked done by worker, so this returns when
+    # queue is empty and nothing is in flight
+    await crawl.worklist.join()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    client.close()
+    log('We have visited {} pages in total'.format(len(crawl.visited)))
+    return crawl.report
+
+def main(uri, loop='auto', **options):
+    '''Crawls site starting from uri, returns report as dict.
+       Loop is `asyncio`, `uvloop` or `auto` (uvloop when installed).
+    '''
+    coro = crawl_site(uri, **options)
+    if loop == 'uvloop' and uvloop is None:
+        raise RuntimeError('uvloop is not installed')
+    if loop != 'asyncio' and uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Simple asyncio web crawler.')
+    parser.add_argument('uri')
+    parser.add_argument('report', help='path to json report')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of pages crawled concurrently')
+    parser.add_argument('--concurrency', type=int, default=HOST_CONCURRENCY,
+                        help='max number of concurrent requests per host')
+    parser.add_argument('--attempts', type=int, default=ATTEMPTS,
+                        help='attempts per request for transient failures')
+    parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE,
+                        help='do not download responses larger than this '
+                             'many bytes')
+    parser.add_argument('--loop', choices=('auto', 'asyncio', 'uvloop'),
+                        default='auto', help='event loop implementation')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    args = parse_args(sys.argv[1:])
+    report = main(args.uri, loop=args.loop, workers=args.workers,
+                  concurrency=args.concurrency, attempts=args.attempts,
+                  max_body_size=args.max_body_size)
+    try:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+    except Exception:
+        logging.exception('Error while writing report to {}'.format(
+            args.report))
+        sys.exit(1)
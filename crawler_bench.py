@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Benchmark for crawler.py and crawler_aio.py on a synthetic site.
+# Site is generated deterministically from seed: pages link to each other
+# (pages are reachable from the first one), share scripts, images and
+# stylesheets, stylesheets reference images and fonts with url() and @import,
+# some links point to files and to missing pages. Some pages are directories
+# (/section/N/) with relative links and their own stylesheet, so links have
+# to be resolved against uri with trailing slash. Site is served by local
+# threading HTTP server with keep-alive, optional latency and transient
+# errors (503 for the first request of some pages).
+# Crawler runs in subprocess without request rate limit, so both engines
+# can be compared (extra arguments could set it again); harness
+# reports pages/s, requests per page, peak memory of crawler process and
+# checks report against expected one. Site larger than prefetch cache of
+# crawler.py fails the run if pages are downloaded more than once.
+#
+# Usage:
+#  ./crawler_bench.py --pages 2000 --latency 20
+#  ./crawler_bench.py --engine asyncio --error-rate 0.05
+#  ./crawler_bench.py --pages 5000 --dynamic-rate 0.6 --latency 20
+#  ./crawler_bench.py --json bench.json -- --processes 4
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import posixpath
+import tempfile
+import threading
+import subprocess
+import collections
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINES = {
+    'eventlet': ('python2', os.path.join(HERE, 'crawler.py')),
+    'asyncio': (sys.executable, os.path.join(HERE, 'crawler_aio.py'))
+}
+# politeness settings, same for both engines: crawler.py limits request
+# rate per host by default, crawler_aio.py has no rate limit
+ENGINE_ARGS = {
+    'eventlet': ['--rate', '0'],
+    'asyncio': []
+}
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript',
+    '.css': 'text/css',
+    '.png': 'image/png',
+    '.woff': 'font/woff',
+    '.pdf': 'application/pdf'
+}
+# same as crawler.PREFETCH_CACHE_SIZE: larger crawls can not keep all pages
+# fetched while resolving content type
+PREFETCH_CACHE_SIZE = 1000
+# GETs of pages (besides stylesheets and retries) per crawled page allowed
+# on such crawls: robots.txt and probes racing budget are fetched as well
+GET_SLACK = 0.02
+
+
+def canonical(path):
+    '''Key of path in report: crawler strips trailing slash.'''
+    return path.rstrip('/') or '/'
+
+def relative(path, page_path):
+    '''Link to path from page at page_path, relative for directory pages.'''
+    if not page_path.endswith('/'):
+        return path
+    (path, sep, query) = path.partition('?')
+    link = posixpath.relpath(path, page_path)
+    if path.endswith('/'):
+        link += '/'
+    return link + sep + query
+
+
+class Site:
+    '''Synthetic site: maps path to (content type, body) and knows report
+       which crawler should produce for it.
+    '''
+    def __init__(self, pages=500, fanout=8, assets=4, shared_assets=200,
+                 stylesheets=20, broken_rate=0.02, dynamic_rate=0.1,
+                 section_rate=0.1, seed=0):
+        self.rng = random.Random(seed)
+        self.resources = {}
+        self.expected = {}
+        self.pages = [self.page_path(i, dynamic_rate, section_rate)
+                      for i in range(pages)]
+        self.missing = set()
+        # stylesheets linked from pages, crawler fetches each once
+        self.linked_stylesheets = set()
+        css_paths = [self.add_stylesheet(k, shared_assets)
+                     for k in range(stylesheets)]
+        for (i, path) in enumerate(self.pages):
+            self.add_page(i, path, fanout, assets, shared_assets, css_paths,
+                          broken_rate)
+        for path in self.missing:
+            self.expected[path] = {'assets': set(), 'links_to': set(),
+                                   'error': 'HTTP 404'}
+
+    def page_path(self, i, dynamic_rate, section_rate):
+        # dynamic pages and directories have no extension, so crawler has
+        # to HEAD them
+        if i:
+            dice = self.rng.random()
+            if dice < dynamic_rate:
+                return '/view?id={}'.format(i)
+            if dice < dynamic_rate + section_rate:
+                return '/section/{}/'.format(i)
+        return '/page/{}.html'.format(i)
+
+    def add_static(self, path):
+        ext = os.path.splitext(path)[1]
+        self.resources.setdefault(path, (CONTENT_TYPES[ext],
+                                         path.encode('utf-8')))
+        return path
+
+    def add_stylesheet(self, k, shared_assets):
+        rules = []
+        resources = set()
+        for n in range(self.rng.randint(1, 4)):
+            img = '/static/img/{}.png'.format(
+                self.rng.randrange(shared_assets))
+            quote = self.rng.choice(['', '"', "'"])
+            rules.append('.c{} {{ background: url({}{}{}); }}'.format(
+                n, quote, '..' + img[len('/static'):], quote))
+            resources.add(self.add_static(img))
+        font = self.add_static('/static/font/{}.woff'.format(k))
+        rules.append("@font-face {{ src: url('../font/{}.woff'); }}".format(k))
+        resources.add(font)
+        if k:
+            rules.insert(0, '@import "{}.css";'.format(k - 1))
+            resources.add('/static/css/{}.css'.format(k - 1))
+        path = '/static/css/{}.css'.format(k)
+        self.resources[path] = ('text/css', '\n'.join(rules).encode('utf-8'))
+        return path, resources
+
+    def add_page(self, i, path, fanout, assets, shared_assets, css_paths,
+                 broken_rate):
+        head = []
+        body = []
+        page_assets = set()
+        page_links = set()
+        for _ in range(assets):
+            script = self.add_static('/static/js/{}.js'.format(
+                self.rng.randrange(shared_assets)))
+            head.append('<script src="{}"></script>'.format(
+                relative(script, path)))
+            img = self.add_static('/static/img/{}.png'.format(
+                self.rng.randrange(shared_assets)))
+            body.append('<img src="{}">'.format(relative(img, path)))
+            page_assets.update([script, img])
+        (css_path, css_resources) = self.rng.choice(css_paths)
+        if path.endswith('/'):
+            # directory has own stylesheet, importing shared one
+            shared_css_path = css_path
+            css_path = path + 'style.css'
+            css_resources = set([shared_css_path])
+            self.resources[css_path] = ('text/css', '@import "{}";'.format(
+                relative(shared_css_path, path)).encode('utf-8'))
+        head.append('<link rel="stylesheet" href="{}">'.format(
+            relative(css_path, path)))
+        self.linked_stylesheets.add(css_path)
+        page_assets.add(css_path)
+        page_assets.update(css_resources)
+        # next page keeps whole site reachable
+        targets = [self.pages[(i + 1) % len(self.pages)]]
+        targets.extend(self.rng.choice(self.pages) for _ in range(fanout - 1))
+        for target in targets:
+            body.append('<a href="{}">page</a>'.format(relative(target, path)))
+            page_links.add(canonical(target))
+        if self.rng.random() < broken_rate:
+            missing = '/missing/{}.html'.format(i)
+            body.append('<a href="{}">broken</a>'.format(
+                relative(missing, path)))
+            page_links.add(missing)
+            self.missing.add(missing)
+        pdf = self.add_static('/files/{}.pdf'.format(i % 10))
+        body.append('<a href="{}">file</a>'.format(relative(pdf, path)))
+        html = '<html><head>{}</head><body>{}</body></html>'.format(
+            ''.join(head), ''.join(body))
+        self.resources[path] = (CONTENT_TYPES['.html'], html.encode('utf-8'))
+        self.expected[canonical(path)] = {'assets': page_assets,
+                                          'links_to': page_links}
+
+
+def make_handler(site, latency, error_rate, seed):
+    counts = collections.Counter()
+    failed = set()
+    lock = threading.Lock()
+    rng = random.Random(seed)
+    # pages failing with 503 on first request, to exercise retries
+    flaky = set(p for p in site.pages if rng.random() < error_rate)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, send_body):
+            with lock:
+                counts[self.command] += 1
+                first = self.path in flaky and self.path not in failed
+                failed.add(self.path)
+            if latency:
+                time.sleep(latency)
+            if first:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.path not in site.resources:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            (content_type, body) = site.resources[self.path]
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond(True)
+
+        def do_HEAD(self):
+            self.respond(False)
+
+    return Handler, counts
+
+
+def check_report(report, expected, base):
+    '''Compares crawler report with expected one, returns list of problems.'''
+    problems = []
+    expected = dict((base + path, record)
+                    for (path, record) in expected.items())
+    for uri in sorted(set(expected) - set(report)):
+        problems.append('missing page {}'.format(uri))
+    for uri in sorted(set(report) - set(expected)):
+        problems.append('unexpected page {}'.format(uri))
+    for uri in sorted(set(report) & set(expected)):
+        got = report[uri]
+        want = expected[uri]
+        if got.get('error') != want.get('error'):
+            problems.append('{}: error {!r}, expected {!r}'.format(
+                uri, got.get('error'), want.get('error')))
+        for key in ('assets', 'links_to'):
+            want_uris = set(base + path for path in want[key])
+            if set(got[key]) != want_uris:
+                problems.append('{}: {} differ, missing {}, extra {}'.format(
+                    uri, key, len(want_uris - set(got[key])),
+                    len(set(got[key]) - want_uris)))
+    return problems
+
+
+def run_crawler(engine, python, base, extra_args):
+    '''Runs crawler in subprocess, returns (report, seconds, peak rss KiB).'''
+    (default_python, script) = ENGINES[engine]
+    with tempfile.TemporaryDirectory() as tmp:
+        report_path = os.path.join(tmp, 'report.json')
+        command = ([python or default_python, script,
+                    base + '/page/0.html', report_path] +
+                   ENGINE_ARGS[engine] + extra_args)
+        started = time.time()
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(command, stdout=devnull,
+                                       stderr=devnull)
+            (_, status, usage) = os.wait4(process.pid, 0)
+        elapsed = time.time() - started
+        if status:
+            raise RuntimeError('Crawler failed: {}'.format(' '.join(command)))
+        with open(report_path) as f:
+            report = json.load(f)
+    return report, elapsed, usage.ru_maxrss
+
+
+def main(engine='eventlet', python=None, pages=500, fanout=8, latency=0,
+         error_rate=0, seed=0, extra_args=(), dynamic_rate=0.1,
+         section_rate=0.1):
+    site = Site(pages=pages, fanout=fanout, dynamic_rate=dynamic_rate,
+                section_rate=section_rate, seed=seed)
+    (handler, counts) = make_handler(site, latency, error_rate, seed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        (report, elapsed, peak_rss) = run_crawler(engine, python, base,
+                                                  list(extra_args))
+    finally:
+        server.shutdown()
+        server.server_close()
+    problems = check_report(report, site.expected, base)
+    crawled = len(report)
+    requests = sum(counts.values())
+    page_gets = counts['GET'] - len(site.linked_stylesheets)
+    if crawled > PREFETCH_CACHE_SIZE:
+        allowed = crawled * (1 + error_rate + GET_SLACK)
+        if page_gets > allowed:
+            problems.append('{} GETs of {} pages, {:.0f} expected at '
+                            'most'.format(page_gets, crawled, allowed))
+    return {
+        'engine': engine,
+        'pages': crawled,
+        'seconds': elapsed,
+        'pages_per_second': crawled / elapsed if elapsed else 0,
+        'requests': dict(counts),
+        'requests_per_page': float(requests) / crawled if crawled else 0,
+        'peak_rss_kib': peak_rss,
+        'problems': problems
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Crawler benchmark.')
+    parser.add_argument('--engine', choices=sorted(ENGINES),
+                        default='eventlet')
+    parser.add_argument('--python', help='interpreter to run crawler with')
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='links to other pages per page')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='server latency per request, ms')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of pages failing with 503 once')
+    parser.add_argument('--dynamic-rate', type=float, default=0.1,
+                        help='fraction of pages without extension')
+    parser.add_argument('--section-rate', type=float, default=0.1,
+                        help='fraction of pages which are directories')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH',
+                        help='write results to this file')
+    parser.add_argument('extra_args', nargs='*',
+                        help='arguments passed to crawler, after --')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    result = main(args.engine, args.python, args.pages, args.fanout,
+                  args.latency / 1000.0, args.error_rate, args.seed,
+                  args.extra_args, args.dynamic_rate, args.section_rate)
+    print('{engine}: {pages} pages in {seconds:.2f}s, {pages_per_second:.1f} '
+          'pages/s, {requests_per_page:.2f} requests/page, peak rss '
+          '{peak_rss_kib} KiB'.format(**result))
+    print('requests: {}'.format(', '.join(
+        '{} {}'.format(method, count)
+        for (method, count) in sorted(result['requests'].items()))))
+    for problem in result['problems'][:20]:
+        print('PROBLEM: {}'.format(problem))
+    if len(result['problems']) > 20:
+        print('... and {} more problems'.format(len(result['problems']) - 20))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4)
+    sys.exit(1 if result['problems'] else 0)
@@ -7,11 +7,62 @@ to number of pure functinos. One can issue GET request to
 /<function name>/<arg1>/<argN> to get result of application of desired
 function to provided arguments.
 
-Currently provided function:
+Currently provided functions:
  /fib/N -> generate N first numbers of fibbonachi sequence (starting from zero)
+ /fib_nth/N -> N-th number of fibbonachi sequence (counting from zero)
+ /fib_range/A/B -> numbers of fibbonachi sequence from A-th up to B-th,
+                   not including B-th one, so /fib_range/0/N is /fib/N
+
+Many calls could be evaluated by one POST /batch request, with JSON list of
+calls (Content-Type: application/json) or one call per line (any other
+type); call is a path (/fib/5) or JSON list of function name and arguments
+(["fib", 5]). Results are sent in the same order, as JSON list or one JSON
+object per line: {"result": ...} or {"error": {...}}.
+Batch shares caches with GET requests, computes each distinct call once and
+lets functions do shared work once (one pass up to the largest N serves
+every smaller one). Streamed results are not available in batch.
+
+Functions are registered in ROUTES with route decorator, which declares
+converters and limits of arguments (too large input is rejected with 422)
+and, optionally, cache of results.
+
+Sequences, whose estimated size of output (about 0.209 * N digits per
+number) exceeds 64 MiB, are rejected with 422 as well.
+
+Sequences larger than 64 KiB are streamed with chunked transfer encoding
+(or until connection is closed, for HTTP/1.0 clients), as they are
+computed, so memory per request does not grow with output.
+
+Numbers are computed as decimals, so they are converted to text in linear
+time, and decimal text of the sequence prefix is cached up to memory budget:
+repeated requests are served from cache. Single numbers beyond cached
+prefix are computed by fast doubling.
+
+By default requests are served concurrently by pool of worker threads;
+accepted connections wait for free worker in bounded queue, and when the
+queue is full, new connections are answered with 503 right away, so load
+balancer can retry them elsewhere. With --mode single requests are served
+one at a time.
+
+With --processes N functions are computed by pool of N worker processes,
+so they use all cores instead of being serialized by GIL. Calls wait for
+free worker process in bounded queue (--process-queue), further calls get
+503; worker, which computes result for longer than --call-timeout seconds,
+is killed and replaced, and the call gets 503 too.
+
+Connections are kept alive (HTTP/1.1) for up to --max-requests requests,
+while they are not idle for longer than --idle-timeout seconds. Connection
+is also closed after response, or while it waits for the next request, if
+other connections wait to be served, so idle clients do not hold workers.
 
 Usage:
  ./httpfuncs.py 127.0.0.1 8080
+ ./httpfuncs.py --workers 32 --queue 128 127.0.0.1 8080
+ ./httpfuncs.py --mode single 127.0.0.1 8080
+ ./httpfuncs.py --processes 4 --call-timeout 2 127.0.0.1 8080
+ printf '/fib/5\n/fib_nth/10\n' | curl --data-binary @- 127.0.0.1:8080/batch
+ curl -H 'Content-Type: application/json' -d '[["fib", 5]]' \
+      127.0.0.1:8080/batch
  or, to run tests:
  ./httpfuncs.py --test
  or, to display help:
@@ -19,11 +70,63 @@ Usage:
 """
 
 import sys
+import json
+import math
+import time
+import signal
+import decimal
+import functools
+import itertools
+import collections
+import queue
+import socket
+import select
+import argparse
 import unittest
+import threading
+import multiprocessing
+import http.client
 
 from http import HTTPStatus
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
+WORKERS = 16
+QUEUE_SIZE = 64
+# keep-alive limits: seconds, connection could be idle, and number of
+# requests served over one connection
+IDLE_TIMEOUT = 5
+MAX_REQUESTS = 100
+# seconds, idle connection waits for next request before it checks, whether
+# other connections wait for its worker
+IDLE_POLL = 0.1
+# bytes of decimal text of fibbonachi numbers kept in cache
+FIB_CACHE_BUDGET = 64 * 1024 * 1024
+# numbers computed at once, while cache is extended
+FIB_EXTEND_STEP = 1000
+# results of more bytes (estimated, see fib_output_size) are streamed
+FIB_STREAM_SIZE = 64 * 1024
+# bytes of streamed response sent in one chunk
+CHUNK_SIZE = 64 * 1024
+# n-th fibbonachi number has about n * log10(golden ratio) decimal digits;
+# sequences with more bytes of estimated output are rejected
+FIB_DIGITS_PER_N = math.log10((1 + math.sqrt(5)) / 2)
+FIB_MAX_OUTPUT = 64 * 1024 * 1024
+# limits of input: index of fibbonachi number and number of numbers in
+# output of /fib, which fits FIB_MAX_OUTPUT (output grows as square of it)
+FIB_MAX_N = 1000000
+FIB_MAX_COUNT = int(
+    (math.sqrt(1 + 2 * FIB_DIGITS_PER_N * FIB_MAX_OUTPUT) - 1) /
+    FIB_DIGITS_PER_N)
+# seconds, worker process may compute one result (or next chunk of
+# streamed one), before it is killed
+CALL_TIMEOUT = 10
+# path of batch endpoint (POST /batch) and limits of batch request
+BATCH = 'batch'
+BATCH_MAX_CALLS = 1000
+BATCH_MAX_BODY = 1024 * 1024
+# bytes of results of all calls of batch, estimated before computing them
+BATCH_MAX_OUTPUT = 16 * 1024 * 1024
+
 def fib(n):
     if n < 0:
         raise ValueError('Fibbonachi sequence is not defined for negative input')
@@ -38,42 +141,845 @@ def fib(n):
         a, b = b, a + b
         yield a
 
+class FibEngine:
+    """Computes fibbonachi numbers as decimal text.
+
+    Text of the sequence prefix is cached: it is extended incrementally,
+    while it fits into budget (in bytes), and never shrinks. Readers do not
+    take lock, as the prefix is only appended to. Numbers are computed in
+    exact decimal arithmetic: unlike int, decimal is converted to text in
+    linear time and without limit on number of digits.
+    """
+    CONTEXT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX,
+                              traps=[decimal.Inexact])
+
+    def __init__(self, budget=FIB_CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.full = False
+        self.prefix = []
+        # next two numbers after the prefix
+        self.a = decimal.Decimal(0)
+        self.b = decimal.Decimal(1)
+        self.lock = threading.Lock()
+
+    def extend(self, n):
+        """Extends prefix up to n numbers, if budget allows. Returns length
+        of the prefix.
+        """
+        if len(self.prefix) >= n or self.full:
+            return len(self.prefix)
+        with self.lock:
+            while len(self.prefix) < n and not self.full:
+                text = str(self.a)
+                if self.size + len(text) > self.budget:
+                    self.full = True
+                    break
+                self.prefix.append(text)
+                self.size += len(text)
+                (self.a, self.b) = (self.b, self.CONTEXT.add(self.a, self.b))
+            return len(self.prefix)
+
+    def pair(self, n):
+        """Returns n-th and (n+1)-th numbers, using fast doubling:
+        F(2k) = F(k) * (2 * F(k+1) - F(k)), F(2k+1) = F(k)^2 + F(k+1)^2.
+        """
+        if n + 1 < len(self.prefix):
+            return (decimal.Decimal(self.prefix[n]),
+                    decimal.Decimal(self.prefix[n + 1]))
+        if self.full and n == len(self.prefix):
+            # full prefix never changes, as well as numbers after it
+            return self.a, self.b
+        ctx = self.CONTEXT
+        (a, b) = (decimal.Decimal(0), decimal.Decimal(1))
+        for bit in bin(n)[2:]:
+            c = ctx.multiply(a, ctx.subtract(ctx.multiply(b, 2), a))
+            d = ctx.add(ctx.multiply(a, a), ctx.multiply(b, b))
+            (a, b) = (d, ctx.add(c, d)) if bit == '1' else (c, d)
+        return a, b
+
+    def range(self, start, stop):
+        """Yields text of numbers from start-th up to stop-th."""
+        if start < 0 or stop < 0:
+            raise ValueError(
+                'Fibbonachi sequence is not defined for negative input')
+        n = start
+        if start <= len(self.prefix):
+            # numbers up to start would be computed anyway, keep them;
+            # prefix is extended step by step, so first numbers are
+            # yielded right away
+            while n < stop:
+                end = min(stop, self.extend(min(stop, n + FIB_EXTEND_STEP)))
+                if end <= n:
+                    break
+                yield from itertools.islice(self.prefix, n, end)
+                n = end
+        if n < stop:
+            (a, b) = self.pair(n)
+            for _ in range(n, stop):
+                yield str(a)
+                (a, b) = (b, self.CONTEXT.add(a, b))
+
+    def nth(self, n):
+        return next(self.range(n, n + 1))
+
+fib_engine = FibEngine()
+
+
+class Arg:
+    """Argument of route: converter from path segment and limits of
+    converted value.
+    """
+    def __init__(self, converter=str, minimum=None, maximum=None):
+        self.converter = converter
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def convert(self, value):
+        value = self.converter(value)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError('Input should not be less than {}'.format(
+                self.minimum))
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError('Input should not be greater than {}'.format(
+                self.maximum))
+        return value
+
+
+class ResultCache:
+    """Thread-safe LRU cache, bounded by total size of values in bytes.
+
+    Entries expire after ttl seconds, if ttl is given.
+    """
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            (value, size, expires) = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                self.size -= size
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_bytes:
+                (_, (_, evicted, _)) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+
+class Route:
+    """Function, available over http: converts and checks arguments, which
+    come as strings, and caches results of pure functions (only strings
+    are cached, streamed results are not).
+
+    CPU-bound functions are marked with offload: while pool of worker
+    processes is set up, they are computed there. Optional prepare is
+    called with arguments of all calls of a batch, before they are
+    computed, to do their shared work once; optional estimate returns
+    approximate size of result in bytes for arguments, so batch can be
+    limited before it is computed.
+    """
+    # ProcessPool, set up by main
+    pool = None
+
+    def __init__(self, func, args, cache=None, name=None, offload=False,
+                 prepare=None, estimate=None):
+        self.func = func
+        self.args = args
+        self.cache = cache
+        self.offload = offload
+        self.prepare = prepare
+        self.estimate = estimate
+        functools.update_wrapper(self, func)
+        self.name = name or func.__name__
+
+    def apply(self, values):
+        if self.offload and self.pool is not None:
+            return self.pool.call(self.name, values)
+        return self.func(*values)
+
+    def convert(self, args):
+        if len(args) != len(self.args):
+            raise TypeError('{} takes {} arguments, {} given'.format(
+                self.name, len(self.args), len(args)))
+        return tuple(arg.convert(value)
+                     for (arg, value) in zip(self.args, args))
+
+    def __call__(self, *args):
+        values = self.convert(args)
+        if self.cache is None:
+            return self.apply(values)
+        result = self.cache.get(values)
+        if result is None:
+            result = self.apply(values)
+            if isinstance(result, str):
+                self.cache.put(values, result)
+        return result
+
+
+ROUTES = {}
+
+def route(name, *args, cache_size=None, cache_ttl=None, offload=False,
+          prepare=None, estimate=None):
+    """Registers function in ROUTES under name, see Route. Arguments are
+    described by Arg instances; results are cached if cache_size (in bytes)
+    is given.
+    """
+    def register(func):
+        cache = ResultCache(cache_size, cache_ttl) if cache_size else None
+        ROUTES[name] = Route(func, args, cache, name, offload, prepare,
+                             estimate)
+        return ROUTES[name]
+    return register
+
+
+def batches(pieces, size=CHUNK_SIZE):
+    """Joins pieces of text into batches of at least size characters."""
+    (buf, length) = ([], 0)
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            (buf, length) = ([], 0)
+    if buf:
+        yield ''.join(buf)
+
+
+class FunctionNotFound(LookupError):
+    """There is no route with requested name."""
+
+
+class BatchTooLarge(ValueError):
+    """Results of batch would take too much memory."""
+
+
+class PoolBusy(Exception):
+    """All worker processes are busy and too many calls wait for them."""
+
+
+class CallTimeout(Exception):
+    """Worker process did not answer in time and was killed."""
+
+
+def task(name):
+    """Function, which worker process applies: route function or, for
+    BATCH, computation of batch.
+    """
+    return compute_batch if name == BATCH else ROUTES[name].func
+
+def work(conn):
+    """Loop of worker process: applies tasks to arguments received over
+    conn and sends back ('result', value), ('error', exception) or, for
+    streamed results, ('chunk', text) messages followed by ('end', None).
+    """
+    # ctrl-c is handled by the server, which kills workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conn.send(('ready', None))
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            break
+        if call is None:
+            break
+        (name, values) = call
+        try:
+            result = task(name)(*values)
+            if isinstance(result, (str, list)):
+                conn.send(('result', result))
+                continue
+            for chunk in batches(result):
+                conn.send(('chunk', chunk))
+            conn.send(('end', None))
+        except Exception as exc:
+            try:
+                conn.send(('error', exc))
+            except Exception:
+                # exception could not be pickled
+                conn.send(('error', RuntimeError(repr(exc))))
+
+
+class ProcessPool:
+    """Computes routes in fixed pool of worker processes, so CPU-bound
+    functions are not serialized by GIL of the server.
+
+    Calls wait for free worker, while no more than queue_size of them are
+    waiting, further calls fail with PoolBusy. Worker, which does not answer
+    in timeout seconds, is killed (so runaway computation is really stopped)
+    and replaced by new one. Workers are spawned, not forked, as the server
+    runs threads, which could hold locks at the moment of fork.
+    """
+    def __init__(self, size, queue_size=QUEUE_SIZE, timeout=CALL_TIMEOUT):
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.waiting = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.workers = set()
+        self.idle = [self.start() for _ in range(size)]
+
+    def start(self):
+        (conn, child_conn) = self.context.Pipe()
+        process = self.context.Process(target=work, args=(child_conn,),
+                                       daemon=True)
+        process.start()
+        child_conn.close()
+        # startup of interpreter should not count against timeout of call
+        conn.recv()
+        worker = (process, conn)
+        with self.cond:
+            self.workers.add(worker)
+        return worker
+
+    def acquire(self):
+        with self.cond:
+            if not self.idle and self.waiting >= self.queue_size:
+                raise PoolBusy('All {} worker processes are busy'.format(
+                    len(self.workers)))
+            self.waiting += 1
+            try:
+                while not self.idle:
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+            return self.idle.pop()
+
+    def release(self, worker):
+        with self.cond:
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def replace(self, worker):
+        """Kills worker, which is in unknown state, and starts new one."""
+        (process, conn) = worker
+        with self.cond:
+            self.workers.discard(worker)
+        process.kill()
+        process.join()
+        conn.close()
+        if not self.closed:
+            self.release(self.start())
+
+    def receive(self, worker):
+        conn = worker[1]
+        if not conn.poll(self.timeout):
+            raise CallTimeout('Function did not finish in {} seconds'.format(
+                self.timeout))
+        return conn.recv()
+
+    def call(self, name, values):
+        """Applies route name to converted values in worker process.
+        Streamed results are returned as iterator, which holds the worker
+        until it is exhausted.
+        """
+        worker = self.acquire()
+        try:
+            worker[1].send((name, values))
+            (kind, value) = self.receive(worker)
+        except BaseException:
+            self.replace(worker)
+            raise
+        if kind == 'chunk':
+            stream = self.stream(worker, value)
+            # started generator releases the worker, even if it is not read
+            next(stream)
+            return stream
+        self.release(worker)
+        if kind == 'error':
+            raise value
+        return value
+
+    def stream(self, worker, chunk):
+        done = False
+        try:
+            yield
+            while True:
+                yield chunk
+                (kind, chunk) = self.receive(worker)
+                if kind != 'chunk':
+                    done = True
+                    if kind == 'error':
+                        raise chunk
+                    return
+        finally:
+            # worker in the middle of abandoned stream is killed
+            if done:
+                self.release(worker)
+            else:
+                self.replace(worker)
+
+    def close(self):
+        self.closed = True
+        with self.cond:
+            workers = list(self.workers)
+        for (process, conn) in workers:
+            process.kill()
+            process.join()
+            conn.close()
+
+
+def separated(pieces, separator=' '):
+    """Lazy separator.join(pieces)."""
+    for (i, piece) in enumerate(pieces):
+        if i:
+            yield separator
+        yield piece
+
+def fib_output_size(start, stop):
+    """Estimated bytes of space-separated numbers from start-th up to
+    stop-th.
+    """
+    count = max(stop - start, 0)
+    return int(FIB_DIGITS_PER_N * (start + stop) / 2 * count) + count
+
+def fib_text(start, stop):
+    """Space-separated numbers, streamed for large output."""
+    size = fib_output_size(start, stop)
+    if size > FIB_MAX_OUTPUT:
+        raise ValueError('Output would take about {} bytes, more than '
+                         '{}'.format(size, FIB_MAX_OUTPUT))
+    numbers = fib_engine.range(start, stop)
+    if size > FIB_STREAM_SIZE:
+        return separated(numbers)
+    return ' '.join(numbers)
+
+def extend_fib(stops):
+    """Prepares batch: extends cached prefix once, up to the largest of
+    stops, so calls of the batch are served from it.
+    """
+    fib_engine.extend(max(stops))
+
+@route('fib', Arg(int, 0, FIB_MAX_COUNT), offload=True,
+       prepare=lambda calls: extend_fib(n for (n,) in calls),
+       estimate=lambda n: fib_output_size(0, n))
 def fib_handler(n):
     """Converts input to integer and output to space-separated string"""
-    return ' '.join(map(str, fib(int(n))))
+    return fib_text(0, n)
+
+@route('fib_nth', Arg(int, 0, FIB_MAX_N), cache_size=16 * 1024 * 1024,
+       offload=True,
+       prepare=lambda calls: extend_fib(n + 1 for (n,) in calls),
+       estimate=lambda n: fib_output_size(n, n + 1))
+def fib_nth_handler(n):
+    return fib_engine.nth(n)
+
+@route('fib_range', Arg(int, 0, FIB_MAX_N), Arg(int, 0, FIB_MAX_N),
+       cache_size=16 * 1024 * 1024, offload=True,
+       prepare=lambda calls: extend_fib(stop for (_, stop) in calls),
+       estimate=fib_output_size)
+def fib_range_handler(start, stop):
+    return fib_text(start, stop)
+
+def parse_batch(body, as_json=False):
+    """Parses body of batch request: JSON list of calls, if as_json, or one
+    call per line. Call is a path (/fib/5) or JSON list of function name
+    and arguments (["fib", 5]). Returns calls as lists of path segments.
+    """
+    text = body.decode('utf-8')
+    if as_json:
+        calls = json.loads(text)
+        if not isinstance(calls, list):
+            raise ValueError('Batch should be JSON list of calls')
+    else:
+        lines = (line.strip() for line in text.splitlines())
+        calls = [json.loads(line) if line.startswith(('"', '[')) else line
+                 for line in lines if line]
+    segments = []
+    for call in calls:
+        if isinstance(call, str):
+            segments.append(call.lstrip('/').split('/'))
+        elif isinstance(call, list) and call and isinstance(call[0], str):
+            segments.append([call[0]] + [str(arg) for arg in call[1:]])
+        else:
+            raise ValueError('Invalid call: {!r}'.format(call))
+    return segments
+
+def compute_batch(calls):
+    """Computes (name, values) calls, returns list of ('result', text) or
+    ('error', exception) in the same order. Shared work of calls of each
+    route is prepared at once. Streamed results are too large for batch.
+    """
+    groups = collections.defaultdict(list)
+    for (name, values) in calls:
+        groups[name].append(values)
+    for (name, group) in groups.items():
+        if ROUTES[name].prepare is not None:
+            ROUTES[name].prepare(group)
+    outcomes = []
+    for (name, values) in calls:
+        try:
+            result = ROUTES[name].func(*values)
+            if not isinstance(result, str):
+                raise ValueError(
+                    'Result is too large for batch, request it separately')
+            outcomes.append(('result', result))
+        except Exception as exc:
+            outcomes.append(('error', exc))
+    return outcomes
+
+def evaluate_batch(calls):
+    """Evaluates calls, given as lists of path segments, returns list of
+    ('result', text) or ('error', exception) in the same order.
+
+    Results are looked up in caches of routes first; missing ones are
+    computed once per distinct call, all together (in worker process, if
+    routes are offloaded), and stored to caches. Raises BatchTooLarge, if
+    estimated size of all results exceeds BATCH_MAX_OUTPUT.
+    """
+    outcomes = [None] * len(calls)
+    # (name, values) -> indices of calls
+    pending = collections.OrderedDict()
+    size = 0
+    for (i, (name, *args)) in enumerate(calls):
+        try:
+            if name not in ROUTES:
+                raise FunctionNotFound('Function not found: {}'.format(name))
+            route = ROUTES[name]
+            values = route.convert(args)
+        except Exception as exc:
+            outcomes[i] = ('error', exc)
+            continue
+        if route.estimate is not None:
+            size += route.estimate(*values)
+            if size > BATCH_MAX_OUTPUT:
+                raise BatchTooLarge(
+                    'Results of batch would take more than {} '
+                    'bytes'.format(BATCH_MAX_OUTPUT))
+        result = route.cache.get(values) if route.cache is not None else None
+        if result is not None:
+            outcomes[i] = ('result', result)
+        else:
+            pending.setdefault((name, values), []).append(i)
+    if pending:
+        misses = list(pending)
+        if (Route.pool is not None and
+                all(ROUTES[name].offload for (name, _) in misses)):
+            computed = Route.pool.call(BATCH, (misses,))
+        else:
+            computed = compute_batch(misses)
+        for ((name, values), (kind, value)) in zip(misses, computed):
+            cache = ROUTES[name].cache
+            if kind == 'result' and cache is not None:
+                cache.put(values, value)
+            for i in pending[(name, values)]:
+                outcomes[i] = (kind, value)
+    return outcomes
+
+def describe_error(exc):
+    """Returns status code, message and explanation of error of call."""
+    if isinstance(exc, FunctionNotFound):
+        return 404, None, str(exc)
+    if isinstance(exc, BatchTooLarge):
+        return 413, None, str(exc)
+    if isinstance(exc, PoolBusy):
+        # back-pressure: client could retry later or elsewhere
+        return 503, None, str(exc)
+    if isinstance(exc, CallTimeout):
+        return 503, 'Function timed out', str(exc)
+    if isinstance(exc, TypeError):
+        # missing parameters, etc
+        return 422, 'Invalid number of arguments', str(exc)
+    if isinstance(exc, ValueError):
+        # invalid input, etc
+        return 422, 'Invalid input for function', str(exc)
+    # any other unexpected errors
+    return 500, None, None
+
+def format_outcome(outcome):
+    (kind, value) = outcome
+    if kind == 'result':
+        return json.dumps({'result': value})
+    (code, message, explain) = describe_error(value)
+    (short, long) = BaseHTTPRequestHandler.responses.get(code, ('???', '???'))
+    return json.dumps({'error': {'code': code, 'message': message or short,
+                                 'explain': explain or long}})
 
-ROUTES = {
-    'fib': fib_handler
-}
 
 class FuncHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # disable html errors
+    error_message_format = '%(code)s %(message)s\n%(explain)s\n'
+    error_content_type = 'application/text'
+    # idle timeout of keep-alive connection
+    timeout = IDLE_TIMEOUT
+    max_requests = MAX_REQUESTS
+    # headers and body are sent separately
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        if self.requests_served and not self.wait_request():
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def wait_request(self):
+        """Waits for the next request on keep-alive connection in slices of
+        IDLE_POLL, so idle connection gives up its worker as soon as other
+        connections wait to be served. Returns whether request came before
+        idle timeout.
+        """
+        # pipelined request could be read into buffer already
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        finally:
+            self.connection.settimeout(self.timeout)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            (readable, _, _) = select.select([self.connection], [], [],
+                                             IDLE_POLL)
+            if readable:
+                return True
+            if self.server.busy() or time.monotonic() >= deadline:
+                return False
+
+    def end_headers(self):
+        # decide, whether connection is kept alive after this response
+        self.requests_served += 1
+        if (not self.close_connection and
+                (self.requests_served >= self.max_requests or
+                 self.server.busy())):
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        super().end_headers()
+
+    def send_body(self, code, body, content_type, message=None, headers=()):
+        self.send_response(code, message)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_func_error(self, code, message=None, explain=None, headers=()):
+        """Same as send_error, but keeps connection alive, as request
+        itself was fine.
+        """
+        (short, long) = self.responses.get(code, ('???', '???'))
+        message = message or short
+        self.log_error("code %d, message %s", code, message)
+        body = self.error_message_format % {
+            'code': code, 'message': message, 'explain': explain or long}
+        self.send_body(code, body.encode('utf-8', 'replace'),
+                       self.error_content_type, message, headers)
+
     def process_result(self, result):
         # without \n at the end of the body,
         # curl will not display the body
         body = result.encode('utf-8') + b"\n"
-        self.send_header('Content-Type', 'application/text')
-        self.send_header('Content-Length', int(len(body)))
+        self.send_body(HTTPStatus.OK, body, 'application/text')
+
+    @staticmethod
+    def chunks(pieces):
+        """Encodes pieces of text, joining them into chunks of CHUNK_SIZE."""
+        for chunk in batches(itertools.chain(pieces, ['\n'])):
+            yield chunk.encode('utf-8')
+
+    def process_stream(self, chunks, content_type='application/text'):
+        """Sends chunks as they are produced, with chunked transfer encoding
+        or, for HTTP/1.0 clients, until connection is closed.
+        """
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
         self.end_headers()
-        self.wfile.write(body)
+        try:
+            for data in chunks:
+                if chunked:
+                    data = b'%x\r\n%b\r\n' % (len(data), data)
+                self.wfile.write(data)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except Exception as exc:
+            # status is sent already, so response could only be broken off
+            self.close_connection = True
+            self.log_error('Streaming of %s failed: %r', self.path, exc)
+
+    def send_call_error(self, exc):
+        headers = [('Retry-After', '1')] if isinstance(exc, PoolBusy) else []
+        self.send_func_error(*describe_error(exc), headers=headers)
 
     def do_GET(self):
-        self.send_response(HTTPStatus.OK)
-        (_, func, *args) = self.path.split('/', 3)
+        (_, func, *args) = self.path.split('/')
+        if func not in ROUTES:
+            self.send_call_error(
+                FunctionNotFound('Function not found: {}'.format(func)))
+            return
         try:
-            self.process_result(ROUTES[func](*args))
-        except KeyError:
-            self.send_error(404,
-                            explain='Function not found: {}'.format(func))
-        except TypeError as exc:
-            # missing parameters, etc
-            self.send_error(422, 'Invalid number of arguments', str(exc))
-            raise
+            result = ROUTES[func](*args)
+            if not isinstance(result, str):
+                # errors of lazy functions are raised by the first chunk
+                chunks = self.chunks(result)
+                result = itertools.chain([next(chunks)], chunks)
+        except Exception as exc:
+            self.send_call_error(exc)
+        else:
+            if isinstance(result, str):
+                self.process_result(result)
+            else:
+                self.process_stream(result)
+
+    def read_body(self, max_size):
+        """Reads body of request, returns None (and sends error), if it
+        could not be read.
+        """
+        error = None
+        length = self.headers.get('Content-Length', '0')
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            error = (411, None, None)
+        elif not length.isdigit():
+            error = (400, None, 'Invalid Content-Length')
+        elif int(length) > max_size:
+            error = (413, None, 'Body should not be larger than {} '
+                                'bytes'.format(max_size))
+        if error is not None:
+            # body is left unread, so connection could not be reused
+            self.close_connection = True
+            self.send_func_error(*error, headers=[('Connection', 'close')])
+            return None
+        return self.rfile.read(int(length))
+
+    def do_POST(self):
+        """Batch of calls: POST /batch with JSON list of calls (Content-Type
+        application/json) or one call per line (any other type, such as
+        application/x-ndjson or text/plain), see parse_batch. Results are
+        sent in the same format, JSON list or one JSON object per line, in
+        the order of calls: {"result": text} or {"error": {"code",
+        "message", "explain"}}.
+        """
+        body = self.read_body(BATCH_MAX_BODY)
+        if body is None:
+            return
+        if self.path != '/' + BATCH:
+            self.send_func_error(
+                404, explain='Only {} accepts POST'.format('/' + BATCH))
+            return
+        as_json = self.headers.get_content_type() == 'application/json'
+        try:
+            calls = parse_batch(body, as_json)
         except ValueError as exc:
-            # invalid input, etc
-            self.send_error(422, 'Invalid input for function', str(exc))
+            self.send_func_error(400, 'Invalid batch', str(exc))
+            return
+        if len(calls) > BATCH_MAX_CALLS:
+            self.send_func_error(
+                413, explain='Batch should not have more than {} '
+                             'calls'.format(BATCH_MAX_CALLS))
+            return
+        try:
+            outcomes = evaluate_batch(calls)
         except Exception as exc:
-            # any other unexpected errors
-            self.send_error(500)
+            self.send_call_error(exc)
+            return
+        lines = map(format_outcome, outcomes)
+        if as_json:
+            pieces = itertools.chain(['['], separated(lines, ',\n'), [']'])
+        else:
+            pieces = separated(lines, '\n')
+        self.process_stream(self.chunks(pieces),
+                            'application/json' if as_json
+                            else 'application/x-ndjson')
+
+
+class FuncHTTPServer(HTTPServer):
+    """HTTPServer, which serves one connection at a time."""
+    def busy(self):
+        """Tells whether other connections wait to be served."""
+        (readable, _, _) = select.select([self.socket], [], [], 0)
+        return bool(readable)
+
+
+class PoolHTTPServer(FuncHTTPServer):
+    """HTTPServer, which handles connections in fixed pool of threads.
+
+    Accepted connections wait for free worker in queue of queue_size,
+    connections accepted while queue is full are rejected with 503.
+    """
+    # whole response: rejected connection gets no handler
+    REJECT = (b'HTTP/1.0 503 Service Unavailable\r\n'
+              b'Content-Type: application/text\r\n'
+              b'Content-Length: 20\r\n'
+              b'Retry-After: 1\r\n'
+              b'\r\n'
+              b'503 Server is busy\n\n')
+
+    def __init__(self, address, handler_class, workers=WORKERS,
+                 queue_size=QUEUE_SIZE):
+        self.request_queue_size = max(queue_size, 5)
+        super().__init__(address, handler_class)
+        self.requests = queue.Queue(queue_size)
+        self.workers = [threading.Thread(target=self.work, daemon=True)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def busy(self):
+        return not self.requests.empty() or super().busy()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject(request)
+
+    def reject(self, request):
+        try:
+            request.sendall(self.REJECT)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
 
 
 class TestFib(unittest.TestCase):
@@ -128,34 +1034,505 @@ class TestFibHandler(unittest.TestCase):
             with self.assertRaises(exc):
                 fib_handler(spec)
 
+class TestFibEngine(unittest.TestCase):
+    def test_prefix(self):
+        engine = FibEngine()
+        self.assertEqual(list(engine.range(0, 30)),
+                         [str(x) for x in fib(30)])
+        self.assertEqual(len(engine.prefix), 30)
+        # served from cache
+        self.assertEqual(list(engine.range(5, 8)), ['5', '8', '13'])
+    def test_budget(self):
+        engine = FibEngine(budget=10)
+        self.assertEqual(list(engine.range(0, 30)),
+                         [str(x) for x in fib(30)])
+        self.assertEqual(engine.prefix, ['0', '1', '1', '2', '3', '5', '8',
+                                         '13'])
+    def test_nth(self):
+        engine = FibEngine()
+        numbers = [str(x) for x in fib(200)]
+        for n in (0, 1, 7, 8, 9, 64, 199):
+            self.assertEqual(engine.nth(n), numbers[n])
+        # only contiguous requests extend the prefix
+        self.assertEqual(len(engine.prefix), 2)
+        self.assertEqual(list(engine.range(150, 153)), numbers[150:153])
+        self.assertEqual(list(engine.range(2, 5)), numbers[2:5])
+        self.assertEqual(len(engine.prefix), 5)
+    def test_large(self):
+        # int could not be converted to text with that many digits
+        text = FibEngine().nth(100000)
+        self.assertEqual(len(text), 20899)
+        (a, b) = (0, 1)
+        for _ in range(100000):
+            (a, b) = (b, (a + b) % 10 ** 10)
+        self.assertEqual(int(text[-10:]), a)
+    def test_invalid_input(self):
+        specs = [(-1, 5), (0, -1)]
+        for (start, stop) in specs:
+            with self.assertRaises(ValueError):
+                list(FibEngine().range(start, stop))
+        self.assertEqual(list(FibEngine().range(5, 2)), [])
+
+class TestFibRangeHandlers(unittest.TestCase):
+    def test_streamed(self):
+        result = fib_range_handler('10', '1011')
+        self.assertNotIsInstance(result, str)
+        self.assertEqual(''.join(result),
+                         ' '.join(map(str, list(fib(1011))[10:])))
+        # few numbers far in sequence are large output too
+        result = fib_range_handler('100000', '100010')
+        self.assertNotIsInstance(result, str)
+        self.assertEqual(next(result), fib_nth_handler('100000'))
+        self.assertIsInstance(fib_range_handler('100000', '100001'), str)
+    def test_nth(self):
+        specs = {
+            '0': '0',
+            '10': '55'
+        }
+        for (spec, answer) in specs.items():
+            self.assertEqual(fib_nth_handler(spec), answer)
+    def test_range(self):
+        specs = {
+            ('0', '5'): '0 1 1 2 3',
+            ('10', '12'): '55 89',
+            ('3', '3'): ''
+        }
+        for ((start, stop), answer) in specs.items():
+            self.assertEqual(fib_range_handler(start, stop), answer)
+    def test_invalid_input(self):
+        for args in [('-1',), ('x',)]:
+            with self.assertRaises(ValueError):
+                fib_nth_handler(*args)
+        with self.assertRaises(ValueError):
+            fib_range_handler('-2', '1')
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_by_size(self):
+        size = sys.getsizeof('a' * 10)
+        cache = ResultCache(size * 2)
+        cache.put(1, 'a' * 10)
+        cache.put(2, 'b' * 10)
+        self.assertEqual(cache.get(1), 'a' * 10)
+        cache.put(3, 'c' * 10)
+        # 2 was least recently used
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'a' * 10)
+        self.assertEqual(cache.size, size * 2)
+        # too large for cache at all
+        cache.put(4, 'd' * 100)
+        self.assertIsNone(cache.get(4))
+    def test_ttl(self):
+        cache = ResultCache(1024, ttl=0.01)
+        cache.put(1, 'a')
+        self.assertEqual(cache.get(1), 'a')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.size, 0)
 
-def main(host, port):
-    FuncHandler.protocol_version = "HTTP/1.0"
-    # disable html errors
-    FuncHandler.error_message_format = '%(code)s %(message)s\n%(explain)s\n'
-    http_server = HTTPServer((host, port), FuncHandler)
+class TestRoute(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def add(a, b):
+            self.calls.append((a, b))
+            return str(a + b)
+        self.route = Route(add, (Arg(int, 0, 10), Arg(int)),
+                           ResultCache(1024))
+    def test_arguments(self):
+        self.assertEqual(self.route('1', '2'), '3')
+        specs = [
+            (('1',), TypeError),
+            (('1', '2', '3'), TypeError),
+            (('x', '2'), ValueError),
+            (('-1', '2'), ValueError),
+            (('11', '2'), ValueError)
+        ]
+        for (args, exc) in specs:
+            with self.assertRaises(exc):
+                self.route(*args)
+    def test_cache(self):
+        self.assertEqual(self.route('1', '2'), '3')
+        self.assertEqual(self.route('1', '02'), '3')
+        self.assertEqual(self.calls, [(1, 2)])
+    def test_limits(self):
+        with self.assertRaises(ValueError):
+            fib_handler(FIB_MAX_COUNT + 1)
+        with self.assertRaises(ValueError):
+            fib_range_handler(0, FIB_MAX_COUNT + 1)
+        # the largest /fib fits output limit
+        self.assertLessEqual(fib_output_size(0, FIB_MAX_COUNT), FIB_MAX_OUTPUT)
+        self.assertNotIsInstance(fib_handler(FIB_MAX_COUNT), str)
+        # indices are in limits, but output is too large
+        with self.assertRaises(ValueError):
+            fib_range_handler(FIB_MAX_N - 1000, FIB_MAX_N)
+        self.assertEqual(''.join(fib_range_handler(FIB_MAX_N - 1, FIB_MAX_N)),
+                         fib_nth_handler(FIB_MAX_N - 1))
+        # estimate is close to actual size
+        text = ''.join(fib_handler(5000))
+        self.assertAlmostEqual(fib_output_size(0, 5000) / len(text), 1,
+                               places=2)
+
+class TestBatch(unittest.TestCase):
+    def test_parse(self):
+        specs = {
+            (b'/fib/5\n\n["fib_nth", 10]\n"fib/2"\n', False):
+                [['fib', '5'], ['fib_nth', '10'], ['fib', '2']],
+            (b' ["/fib/5", ["fib_range", 1, 3], ["fib"]]', True):
+                [['fib', '5'], ['fib_range', '1', '3'], ['fib']],
+            # lines of JSON lists are not JSON list
+            (b'["fib", 5]\n["fib_nth", 10]\n', False):
+                [['fib', '5'], ['fib_nth', '10']],
+            (b'["fib", "5"]', False): [['fib', '5']],
+            (b'["fib", "5"]', True): [['fib'], ['5']],
+            (b'', False): []
+        }
+        for ((body, as_json), answer) in specs.items():
+            self.assertEqual(parse_batch(body, as_json), answer)
+        for (body, as_json) in [(b'[1]', True), (b'[[]]', True), (b'[', True),
+                                (b'', True), (b'{"fib": 5}', True),
+                                (b'\xff', False), (b'{"fib": 5}\n[5]', False)]:
+            with self.assertRaises(ValueError):
+                parse_batch(body, as_json)
+    def test_evaluate(self):
+        # about 100 KiB of output, streamed
+        big = '1000'
+        outcomes = evaluate_batch([['fib', '5'], ['fib_nth', '30'],
+                                   ['nope'], ['fib_nth', 'x'], ['fib', big],
+                                   ['fib_nth', '030']])
+        self.assertEqual(outcomes[:2], [('result', '0 1 1 2 3'),
+                                        ('result', '832040')])
+        self.assertEqual(outcomes[5], outcomes[1])
+        for (i, exc) in [(2, FunctionNotFound), (3, ValueError),
+                         (4, ValueError)]:
+            self.assertIsInstance(outcomes[i][1], exc)
+        # results are shared with GET requests
+        self.assertEqual(ROUTES['fib_nth'].cache.get((30,)), '832040')
+        # total size of results is limited before anything is computed
+        with self.assertRaises(BatchTooLarge):
+            evaluate_batch([['fib_range', '100000', '100200']] * 5)
+    def test_shared_prefix(self):
+        stops = [5000, 20, 3000]
+        calls = [('fib_nth', (n,)) for n in stops]
+        self.assertEqual(compute_batch(calls),
+                         [('result', fib_engine.nth(n)) for n in stops])
+        # one pass up to the largest number serves smaller ones
+        self.assertGreaterEqual(len(fib_engine.prefix), 5001)
+    def test_format(self):
+        self.assertEqual(json.loads(format_outcome(('result', '55'))),
+                         {'result': '55'})
+        error = json.loads(format_outcome(('error', TypeError('no'))))
+        self.assertEqual(error['error']['code'], 422)
+        self.assertEqual(error['error']['explain'], 'no')
+
+
+class TestPoolHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        test = self
+        class BlockingHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.started.set()
+                test.release.wait(5)
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Length', 0)
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        self.server = PoolHTTPServer(('127.0.0.1', 0), BlockingHandler,
+                                     workers=1, queue_size=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get(self):
+        conn = socket.create_connection(self.server.server_address, 5)
+        conn.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        return conn
+
+    def read(self, conn):
+        data = b''
+        while True:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        conn.close()
+        return data.split(b'\r\n', 1)[0]
+
+    def test_overflow_rejected(self):
+        busy = self.get()
+        self.assertTrue(self.started.wait(5))
+        queued = self.get()
+        # queued connection must be accepted before the next one
+        while self.server.requests.empty():
+            time.sleep(0.01)
+        rejected = self.get()
+        self.assertEqual(self.read(rejected),
+                         b'HTTP/1.0 503 Service Unavailable')
+        self.release.set()
+        self.assertEqual(self.read(busy), b'HTTP/1.0 200 OK')
+        self.assertEqual(self.read(queued), b'HTTP/1.0 200 OK')
+
+class TestFuncHandler(unittest.TestCase):
+    def setUp(self):
+        class QuietHandler(FuncHandler):
+            max_requests = 3
+            timeout = 0.5
+            def log_message(self, *args):
+                pass
+        self.server = PoolHTTPServer(('127.0.0.1', 0), QuietHandler,
+                                     workers=2, queue_size=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.conn = http.client.HTTPConnection(*self.server.server_address,
+                                               timeout=5)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get(self, path):
+        self.conn.request('GET', path)
+        sock = self.conn.sock
+        response = self.conn.getresponse()
+        return response, response.read(), sock
+
+    def test_keep_alive(self):
+        specs = [
+            ('/fib/5', 200, b'0 1 1 2 3\n', None),
+            ('/nope/1', 404, None, None),
+            ('/fib/-1', 422, None, 'close')
+        ]
+        socks = set()
+        for (path, status, body, connection) in specs:
+            (response, data, sock) = self.get(path)
+            socks.add(sock)
+            self.assertEqual(response.status, status)
+            self.assertEqual(int(response.getheader('Content-Length')),
+                             len(data))
+            if body is not None:
+                self.assertEqual(data, body)
+            # max_requests closes connection after the third one
+            self.assertEqual(response.getheader('Connection'), connection)
+        self.assertEqual(len(socks), 1)
+        self.assertIsNone(self.conn.sock)
+
+    def test_streaming(self):
+        (response, data, sock) = self.get('/fib/3000')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertIsNone(response.getheader('Content-Length'))
+        self.assertEqual(data, ' '.join(map(str, fib(3000))).encode('utf-8') +
+                         b'\n')
+        # errors are found before response is started
+        (response, _, next_sock) = self.get('/fib_range/-5/5000')
+        self.assertEqual(response.status, 422)
+        self.assertIs(next_sock, sock)
+
+    def test_streaming_http10(self):
+        conn = socket.create_connection(self.server.server_address, 5)
+        conn.sendall(b'GET /fib/2000 HTTP/1.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        conn.close()
+        (head, body) = data.split(b'\r\n\r\n', 1)
+        self.assertNotIn(b'chunked', head)
+        self.assertEqual(body, ' '.join(map(str, fib(2000))).encode('utf-8') +
+                         b'\n')
+
+    def post(self, path, body, content_type='application/x-ndjson'):
+        self.conn.request('POST', path, body, {'Content-Type': content_type})
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def test_batch(self):
+        # body is read, connection is kept alive
+        (response, _) = self.post('/fib/3', b'[]')
+        self.assertEqual(response.status, 404)
+        self.assertIsNone(response.getheader('Connection'))
+        (response, data) = self.post('/batch', b'/fib/3\n["fib_nth", -1]\n')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'),
+                         'application/x-ndjson')
+        lines = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual(lines[0], {'result': '0 1 1'})
+        self.assertEqual(lines[1]['error']['code'], 422)
+        (response, data) = self.post('/batch', b'[["fib_range", 3, 6]]',
+                                     'application/json')
+        self.assertEqual(json.loads(data), [{'result': '2 3 5'}])
+        (response, _) = self.post('/batch', b'[1]', 'application/json')
+        self.assertEqual(response.status, 400)
+        (response, _) = self.post('/batch', b'/fib_range/200000/201000\n')
+        self.assertEqual(response.status, 413)
+        # too large body is not read at all
+        conn = socket.create_connection(self.server.server_address, 5)
+        conn.sendall(b'POST /batch HTTP/1.1\r\nContent-Length: %d\r\n\r\n' %
+                     (BATCH_MAX_BODY + 1))
+        response = http.client.HTTPResponse(conn)
+        response.begin()
+        self.assertEqual(response.status, 413)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        conn.close()
+
+    def test_idle_timeout(self):
+        (_, _, sock) = self.get('/fib/1')
+        sock.settimeout(5)
+        # server closes idle connection
+        self.assertEqual(sock.recv(1), b'')
+
+    def test_idle_released(self):
+        self.server.RequestHandlerClass.timeout = 5
+        # both workers are held by idle keep-alive connections
+        idle = [http.client.HTTPConnection(*self.server.server_address,
+                                           timeout=5) for _ in range(2)]
+        for conn in idle:
+            conn.request('GET', '/fib/1')
+            conn.getresponse().read()
+        started = time.monotonic()
+        (response, data, _) = self.get('/fib/3')
+        self.assertEqual(data, b'0 1 1\n')
+        self.assertLess(time.monotonic() - started, 1)
+        for conn in idle:
+            conn.close()
+
+    def test_pipelined(self):
+        conn = socket.create_connection(self.server.server_address, 5)
+        # second request is read into buffer together with the first one
+        conn.sendall(b'GET /fib/2 HTTP/1.1\r\n\r\n'
+                     b'GET /fib/3 HTTP/1.1\r\n\r\n')
+        data = b''
+        while not data.endswith(b'0 1 1\n'):
+            data += conn.recv(1024)
+        conn.close()
+        self.assertIn(b'0 1\n', data)
+        self.assertTrue(data.endswith(b'0 1 1\n'))
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ProcessPool(1, queue_size=0, timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_call(self):
+        self.assertEqual(self.pool.call('fib', (5,)), '0 1 1 2 3')
+        with self.assertRaises(ValueError):
+            self.pool.call('fib_range', (0, FIB_MAX_COUNT + 1))
+        stream = self.pool.call('fib', (3000,))
+        self.assertNotIsInstance(stream, str)
+        # the only worker streams the result, no one could wait for it
+        with self.assertRaises(PoolBusy):
+            self.pool.call('fib', (1,))
+        self.assertEqual(''.join(stream), ' '.join(map(str, fib(3000))))
+        self.assertEqual(self.pool.call('fib_nth', (10,)), '55')
+
+    def test_timeout(self):
+        self.pool.timeout = 0.01
+        with self.assertRaises(CallTimeout):
+            self.pool.call('fib_nth', (FIB_MAX_N,))
+        # killed worker is replaced
+        self.pool.timeout = 5
+        self.assertEqual(self.pool.call('fib_nth', (10,)), '55')
+        self.assertEqual(len(self.pool.workers), 1)
+
+    def test_abandoned_stream(self):
+        (process, _) = next(iter(self.pool.workers))
+        stream = self.pool.call('fib', (20000,))
+        next(stream)
+        del stream
+        process.join(5)
+        self.assertFalse(process.is_alive())
+        self.assertEqual(self.pool.call('fib', (2,)), '0 1')
+
+    def test_route(self):
+        Route.pool = self.pool
+        try:
+            self.assertEqual(fib_range_handler('20', '22'), '6765 10946')
+            # about 100 KiB of output, streamed
+            big = '1000'
+            outcomes = evaluate_batch([['fib_nth', '40'], ['fib', big]])
+            self.assertEqual(outcomes[0], ('result', '102334155'))
+            # error of the worker process
+            self.assertIsInstance(outcomes[1][1], ValueError)
+        finally:
+            Route.pool = None
+
+
+def main(host, port, mode='threads', workers=WORKERS, queue_size=QUEUE_SIZE,
+         idle_timeout=IDLE_TIMEOUT, max_requests=MAX_REQUESTS, processes=0,
+         process_queue_size=QUEUE_SIZE, call_timeout=CALL_TIMEOUT):
+    FuncHandler.timeout = idle_timeout
+    FuncHandler.max_requests = max_requests
+    if processes:
+        Route.pool = ProcessPool(processes, process_queue_size, call_timeout)
+    if mode == 'single':
+        http_server = FuncHTTPServer((host, port), FuncHandler)
+    else:
+        http_server = PoolHTTPServer((host, port), FuncHandler, workers,
+                                     queue_size)
     try:
         http_server.serve_forever()
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting")
         http_server.server_close()
+        if Route.pool is not None:
+            Route.pool.close()
         sys.exit(0)
 
-def usage_and_exit(msg=None, error=True):
-    out = sys.stderr if error else sys.stdout
-    if msg:
-        print(msg, file=out)
-        print(file=out)
-    print(__doc__, file=out)
-    sys.exit(int(error))
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('host', nargs='?')
+    parser.add_argument('port', nargs='?', type=int)
+    parser.add_argument('--test', action='store_true', help='run tests')
+    parser.add_argument('--mode', choices=['threads', 'single'],
+                        default='threads',
+                        help='serve requests by pool of threads or one at a '
+                             'time (default: threads)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of worker threads (default: {})'.format(
+                            WORKERS))
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE,
+                        help='connections waiting for worker, beyond that '
+                             'they get 503 (default: {})'.format(QUEUE_SIZE))
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds, idle keep-alive connection is kept '
+                             'open (default: {})'.format(IDLE_TIMEOUT))
+    parser.add_argument('--max-requests', type=int, default=MAX_REQUESTS,
+                        help='requests served over one connection '
+                             '(default: {})'.format(MAX_REQUESTS))
+    parser.add_argument('--processes', type=int, default=0,
+                        help='number of worker processes, computing CPU-bound '
+                             'functions (default: 0, compute in server '
+                             'threads)')
+    parser.add_argument('--process-queue', type=int, default=QUEUE_SIZE,
+                        help='calls waiting for worker process, beyond that '
+                             'they get 503 (default: {})'.format(QUEUE_SIZE))
+    parser.add_argument('--call-timeout', type=float, default=CALL_TIMEOUT,
+                        help='seconds, worker process may compute, before '
+                             'it is killed (default: {})'.format(CALL_TIMEOUT))
+    args = parser.parse_args(argv)
+    if not args.test and args.port is None:
+        parser.error('Incorrect number of arguments provided!')
+    return args
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        if sys.argv[1] == '--help':
-            usage_and_exit(error=False)
-        elif sys.argv[1] == '--test':
-            unittest.main(argv=sys.argv[:1])
-    elif len(sys.argv) == 3:
-        main(sys.argv[1], int(sys.argv[2]))
+    args = parse_args(sys.argv[1:])
+    if args.test:
+        unittest.main(argv=sys.argv[:1])
     else:
-        usage_and_exit('Incorrect number of arguments provided!')
+        main(args.host, args.port, args.mode, args.workers, args.queue,
+             args.idle_timeout, args.max_requests, args.processes,
+             args.process_queue, args.call_timeout)